@@ -1,10 +1,42 @@
-from flask import Flask, request, jsonify
+import csv
+import functools
+import hashlib
+import importlib
+import io
+import json
+import math
+import mmap
+import operator
+import os
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, nullcontext
+
+from flask import Flask, Response, request, jsonify
 
 app = Flask(__name__)
 
 ##################################
 # Utility validation helpers
 ##################################
+@functools.lru_cache(maxsize=None)
+def optional_import(name):
+    """
+    Import an optional dependency on first use, returning None if it is
+    not installed. Deferring numpy/pyarrow keeps them off the startup path.
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
 def check_required_fields(data, required_fields):
     """
     Check if all required fields are in the data.
@@ -16,6 +48,17 @@ def check_required_fields(data, required_fields):
             return False, f"'{field}' is required."
     return True, None
 
+def check_string_fields(data, fields):
+    """
+    Check that each of the given fields, where present, is a string.
+    Returns (True, None) if so,
+    otherwise (False, error_msg).
+    """
+    for field in fields:
+        if field in data and not isinstance(data[field], str):
+            return False, f"'{field}' must be a string."
+    return True, None
+
 def make_error_response(msg, code=400):
     """
     Returns a JSON response with an 'error' key and the provided status code (default 400).
@@ -55,44 +98,1418 @@ def validate_int_positive(value, field_name):
     return val
 
 ##################################
-# HOUSE
+# IDEMPOTENCY
 ##################################
-@app.route('/house/add', methods=['POST'])
-def house_add():
+IDEMPOTENCY_TTL = 600             # seconds a key is remembered
+IDEMPOTENCY_MAX_ENTRIES = 100000
+IDEMPOTENCY_MAX_BYTES = 16 * 1024 * 1024
+IDEMPOTENCY_ENTRY_OVERHEAD = 200  # bytes per entry: the entry tuple, its OrderedDict slot and link
+IDEMPOTENCY_WAIT = 10             # seconds a retry waits for the original request
+
+class IdempotencyCache:
+    """
+    Bounded, time-windowed cache of responses keyed by idempotency key.
+    Entries live in insertion order, so the oldest (and first to expire)
+    are always at the front: lookups, inserts and evictions are all O(1).
+    Each entry keeps the fingerprint of the request that produced it, and
+    keys whose first request is still running are tracked as in flight.
+    """
+    def __init__(self, ttl=IDEMPOTENCY_TTL, max_entries=IDEMPOTENCY_MAX_ENTRIES,
+                 max_bytes=IDEMPOTENCY_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        # key -> (fingerprint, threading.Event set when the request finishes)
+        self.in_flight = {}
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def begin(self, key, fingerprint):
+        """
+        Claim `key` for a request with the given fingerprint. Returns one of
+          ("replay", (body, status)) - a response is cached for this request,
+          ("mismatch", None)         - the key was used for a different request,
+          ("wait", event)            - the same request is still in flight,
+          ("run", None)              - the caller must process it, then finish().
+        """
+        with self.lock:
+            self._expire(time.monotonic())
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[3] != fingerprint:
+                    return "mismatch", None
+                return "replay", entry[1:3]
+            flight = self.in_flight.get(key)
+            if flight is not None:
+                if flight[0] != fingerprint:
+                    return "mismatch", None
+                return "wait", flight[1]
+            self.in_flight[key] = (fingerprint, threading.Event())
+            return "run", None
+
+    def finish(self, key, body=None, status=None):
+        """
+        Release a key claimed by begin(), caching the response if one is given.
+        """
+        with self.lock:
+            fingerprint, event = self.in_flight.pop(key)
+            if body is not None:
+                self._put(key, body, status, fingerprint)
+        event.set()
+
+    def _put(self, key, body, status, fingerprint):
+        now = time.monotonic()
+        self._expire(now)
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[4]
+        # Count everything the entry keeps alive, not just the response body
+        parts = key if isinstance(key, tuple) else ()
+        size = (IDEMPOTENCY_ENTRY_OVERHEAD
+                + sum(map(sys.getsizeof, (key, *parts, body, status, fingerprint))))
+        self.entries[key] = (now + self.ttl, body, status, fingerprint, size)
+        self.size += size
+        while self.entries and (len(self.entries) > self.max_entries
+                                or self.size > self.max_bytes):
+            self._evict_oldest()
+
+    def _expire(self, now):
+        while self.entries:
+            expires = next(iter(self.entries.values()))[0]
+            if expires > now:
+                break
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        _, entry = self.entries.popitem(last=False)
+        self.size -= entry[4]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+idempotency_cache = IdempotencyCache()
+
+def request_fingerprint():
+    """
+    Return a hash of the current request body. JSON bodies are hashed in
+    canonical form, so retries that only reorder keys still match.
+    """
+    data = request.get_json(force=True, silent=True)
+    body = request.get_data() if data is None else json.dumps(data, sort_keys=True).encode()
+    return hashlib.sha256(body).hexdigest()
+
+def idempotent(key_field=None):
+    """
+    Route decorator answering retried requests from idempotency_cache.
+    The key comes from the 'Idempotency-Key' header or, if given,
+    the `key_field` of the JSON body. Requests without a key are
+    processed normally; server errors (5xx) are never cached.
+    Reusing a key for a different body is rejected with 422; a retry that
+    arrives while the original is running waits for its response, or gets
+    409 if it is still running after IDEMPOTENCY_WAIT seconds.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get("Idempotency-Key")
+            if key is None and key_field:
+                data = request.get_json(force=True, silent=True)
+                if isinstance(data, dict):
+                    key = data.get(key_field)
+            if key is None:
+                return view(*args, **kwargs)
+
+            cache_key = (request.path, str(key))
+            fingerprint = request_fingerprint()
+            state, value = idempotency_cache.begin(cache_key, fingerprint)
+            if state == "wait":
+                value.wait(IDEMPOTENCY_WAIT)
+                state, value = idempotency_cache.begin(cache_key, fingerprint)
+                if state == "wait":
+                    return make_error_response(
+                        "A request with this Idempotency-Key is still in progress.", 409)
+            if state == "mismatch":
+                return make_error_response(
+                    "Idempotency-Key was already used for a different request.", 422)
+            if state == "replay":
+                body, status = value
+                return Response(body, status=status, mimetype="application/json",
+                                headers={"Idempotent-Replayed": "true"})
+
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except BaseException:
+                idempotency_cache.finish(cache_key)
+                raise
+            if response.status_code < 500:
+                idempotency_cache.finish(cache_key, response.get_data(), response.status_code)
+            else:
+                idempotency_cache.finish(cache_key)
+            return response
+        return wrapper
+    return decorator
+
+##################################
+# SENSOR STORAGE
+##################################
+# Rows per segment before the active segment is sealed to disk.
+SEGMENT_ROWS = 65536
+
+# (column, array typecode): timestamp int64, value float64, series id int32.
+# Columns are written under temporary names and renamed into place, the
+# series id column last, so its presence marks a complete segment.
+SENSOR_COLUMNS = (("ts", "q"), ("val", "d"), ("sid", "i"))
+
+# One active-segment row in the write-ahead log, in SENSOR_COLUMNS order.
+SENSOR_WAL_RECORD = struct.Struct("=qdi")
+
+def read_json_lines(path, chunk_size=1 << 16):
+    """
+    Yield the JSON value of every line of an append-only log.
+    A final fragment without a newline is a torn write (a crash mid-append):
+    once the lines are exhausted it is truncated away, so the next append
+    starts cleanly. A bad line that does end in a newline is corruption,
+    and raises RuntimeError rather than dropping the commits after it.
+    Lines are parsed a chunk at a time with a single json.loads() call
+    (json.dumps never writes raw newlines), falling back to one line at a
+    time only for a chunk holding a bad line.
+    """
+    good = 0
+    pending = b""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            data = pending + chunk
+            cut = data.rfind(b"\n") + 1
+            lines, pending = data[:cut], data[cut:]
+            if not lines:
+                continue
+            try:
+                values = json.loads(b"[" + lines[:-1].replace(b"\n", b",") + b"]")
+            except ValueError:
+                values = []
+                offset = good
+                for line in lines.splitlines(keepends=True):
+                    try:
+                        values.append(json.loads(line))
+                    except ValueError:
+                        raise RuntimeError(f"{path} is corrupt at byte {offset}.")
+                    offset += len(line)
+            yield from values
+            good += len(lines)
+    if pending:
+        os.truncate(path, good)
+
+def fsync_dir(path):
+    """
+    Make renames and new files in directory `path` durable.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class SensorSegment:
+    """
+    A sealed, read-only segment of sensor reports.
+    Each column is a fixed-width binary file (native byte order) that is
+    opened with mmap and exposed as a typed memoryview, so reads never copy
+    or deserialize rows. numpy.frombuffer() can wrap the views directly.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._maps = []
+        self.columns = {}
+        sizes = {os.path.getsize(f"{prefix}.{column}") // array(typecode).itemsize
+                 for column, typecode in SENSOR_COLUMNS}
+        if len(sizes) != 1 or 0 in sizes:
+            raise RuntimeError(f"Sensor segment {prefix} is damaged: "
+                               "its columns are empty or differ in length.")
+        for column, typecode in SENSOR_COLUMNS:
+            with open(f"{prefix}.{column}", "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps.append(mm)
+            self.columns[column] = memoryview(mm).cast(typecode)
+
+    def __len__(self):
+        return len(self.columns["ts"])
+
+    def prefetch(self):
+        """
+        Ask the OS to start reading the column files into the page cache.
+        """
+        if hasattr(mmap, "MADV_WILLNEED"):
+            for mm in self._maps:
+                mm.madvise(mmap.MADV_WILLNEED)
+
+    def close(self):
+        for view in self.columns.values():
+            view.release()
+        for mm in self._maps:
+            mm.close()
+        self.columns = {}
+        self._maps = []
+
+class SensorStore:
+    """
+    Append-only store for sensor reports.
+    New rows go to an in-memory active segment; once it holds
+    `segment_rows` rows it is sealed into column files under `data_dir`
+    and reopened as an mmap-backed SensorSegment.
+    Series are identified by (belong_to_room, name, sensor_type).
+
+    Every new series is appended to `series.jsonl` and every active row to
+    the segment's write-ahead log (`active-NNNNNN.wal`) before it is
+    acknowledged, so a restart replays the rows that were not sealed yet.
+    """
+    def __init__(self, data_dir, segment_rows=SEGMENT_ROWS):
+        self.data_dir = data_dir
+        self.segment_rows = segment_rows
+        self.series = []
+        self.series_ids = {}
+        self.room_series = {}
+        self.segments = []
+        self.lock = threading.Lock()
+        self._series_log = None
+        self._wal = None
+        self._reset_active()
+        self._load()
+
+    def _reset_active(self):
+        self.active = {column: array(typecode) for column, typecode in SENSOR_COLUMNS}
+
+    def _wal_path(self, segment_number):
+        return os.path.join(self.data_dir, f"active-{segment_number:06d}.wal")
+
+    def _open_log(self, path):
+        # Unbuffered, so every record reaches the OS before the request returns
+        os.makedirs(self.data_dir, exist_ok=True)
+        return open(path, "ab", buffering=0)
+
+    def _load(self):
+        """
+        Reopen the series registry, sealed segments and the active segment's
+        write-ahead log left by a previous run. A torn record at the end of
+        a log (crash mid-write) is truncated away.
+        """
+        if not os.path.isdir(self.data_dir):
+            return
+        series_path = os.path.join(self.data_dir, "series.jsonl")
+        if os.path.exists(series_path):
+            for key in read_json_lines(series_path):
+                self._register(*key)
+
+        for entry in sorted(os.listdir(self.data_dir)):
+            if entry.startswith("segment-") and entry.endswith(".sid"):
+                prefix = os.path.join(self.data_dir, entry[:-len(".sid")])
+                self.segments.append(SensorSegment(prefix))
+
+        wal_path = self._wal_path(len(self.segments))
+        for entry in os.listdir(self.data_dir):
+            path = os.path.join(self.data_dir, entry)
+            # Logs of segments that were sealed before the crash are stale,
+            # and so are columns of a seal that never completed
+            if entry.startswith("active-") and entry.endswith(".wal") and path != wal_path:
+                os.remove(path)
+            elif entry.startswith("segment-") and entry.endswith(".tmp"):
+                os.remove(path)
+        if os.path.exists(wal_path):
+            with open(wal_path, "rb") as f:
+                data = f.read()
+            good = len(data) - len(data) % SENSOR_WAL_RECORD.size
+            for ts, val, sid in SENSOR_WAL_RECORD.iter_unpack(data[:good]):
+                self.active["ts"].append(ts)
+                self.active["val"].append(val)
+                self.active["sid"].append(sid)
+            if good < len(data):
+                os.truncate(wal_path, good)
+
+    def _register(self, belong_to_room, name, sensor_type):
+        key = (belong_to_room, name, sensor_type)
+        sid = len(self.series)
+        self.series.append(key)
+        self.series_ids[key] = sid
+        self.room_series.setdefault(belong_to_room, []).append(sid)
+        return sid
+
+    def series_id(self, belong_to_room, name, sensor_type):
+        """
+        Return the int32 id of a series, registering (and logging) it if it is new.
+        """
+        key = (belong_to_room, name, sensor_type)
+        sid = self.series_ids.get(key)
+        if sid is not None:
+            return sid
+        with self.lock:
+            sid = self.series_ids.get(key)
+            if sid is None:
+                if self._series_log is None:
+                    self._series_log = self._open_log(os.path.join(self.data_dir, "series.jsonl"))
+                self._series_log.write(json.dumps(key).encode() + b"\n")
+                sid = self._register(*key)
+            return sid
+
+    def series_ids_for(self, rooms, name=None):
+        """
+        Return the ids of every series in the given rooms,
+        optionally restricted to a single device name.
+        """
+        ids = []
+        for room in rooms:
+            for sid in self.room_series.get(room, ()):
+                if name is None or self.series[sid][1] == name:
+                    ids.append(sid)
+        return ids
+
+    def append(self, series_id, timestamp, value):
+        """
+        Append one reading; seals the active segment when it is full.
+        """
+        with self.lock:
+            if self._wal is None:
+                self._wal = self._open_log(self._wal_path(len(self.segments)))
+            self._wal.write(SENSOR_WAL_RECORD.pack(timestamp, value, series_id))
+            self.active["ts"].append(timestamp)
+            self.active["val"].append(value)
+            self.active["sid"].append(series_id)
+            if len(self.active["ts"]) >= self.segment_rows:
+                self._seal()
+
+    def seal(self):
+        """
+        Seal the active segment to disk. Returns the new segment, or None if empty.
+        """
+        with self.lock:
+            return self._seal()
+
+    def _seal(self):
+        if not self.active["ts"]:
+            return None
+        os.makedirs(self.data_dir, exist_ok=True)
+
+        number = len(self.segments)
+        prefix = os.path.join(self.data_dir, f"segment-{number:06d}")
+        for column, _ in SENSOR_COLUMNS:
+            with open(f"{prefix}.{column}.tmp", "wb") as f:
+                self.active[column].tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+        # Rename in SENSOR_COLUMNS order: .sid only appears once the rest is in place
+        for column, _ in SENSOR_COLUMNS:
+            os.replace(f"{prefix}.{column}.tmp", f"{prefix}.{column}")
+        fsync_dir(self.data_dir)
+
+        # The segment is durable, so its write-ahead log can go
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+        if os.path.exists(self._wal_path(number)):
+            os.remove(self._wal_path(number))
+
+        segment = SensorSegment(prefix)
+        self.segments.append(segment)
+        self._reset_active()
+        return segment
+
+    def scan(self):
+        """
+        Yield (ts, val, sid) columns for every sealed segment, then the active one.
+        Sealed columns are zero-copy mmap views; the active segment (at most
+        `segment_rows` rows) is copied so appends can continue while scanning.
+        """
+        with self.lock:
+            segments = list(self.segments)
+            active = [self.active[column][:] for column, _ in SENSOR_COLUMNS]
+        for segment in segments:
+            columns = segment.columns
+            yield columns["ts"], columns["val"], columns["sid"]
+        if active[0]:
+            yield tuple(active)
+
+    def _matching(self, np, columns, wanted, start, end):
+        """
+        Return numpy copies of the (ts, val, sid) rows of one segment that match
+        the filters. The mmap views are only borrowed inside this call, so the
+        segment can still be closed while callers hold the result.
+        """
+        ts, val, sid = (np.frombuffer(column, dtype=typecode)
+                        for column, (_, typecode) in zip(columns, SENSOR_COLUMNS))
+        mask = np.ones(len(ts), dtype=bool) if wanted is None else np.isin(sid, wanted)
+        if start is not None:
+            mask &= ts >= start
+        if end is not None:
+            mask &= ts < end
+        return ts[mask], val[mask], sid[mask]
+
+    def iter_batches(self, series_ids=None, start=None, end=None, batch_rows=8192):
+        """
+        Yield (ts, val, sid) lists of at most `batch_rows` matching rows, in storage order.
+        Only one batch is materialized at a time. With numpy installed each
+        segment is filtered with a vectorized mask; otherwise row by row.
+        """
+        np = optional_import("numpy")
+        if np is not None:
+            wanted = None if series_ids is None else np.array(sorted(set(series_ids)), dtype=np.int32)
+            for columns in self.scan():
+                ts, val, sid = self._matching(np, columns, wanted, start, end)
+                for first in range(0, len(ts), batch_rows):
+                    last = first + batch_rows
+                    yield ts[first:last].tolist(), val[first:last].tolist(), sid[first:last].tolist()
+            return
+
+        wanted = None if series_ids is None else set(series_ids)
+        batch = ([], [], [])
+        for ts_col, val_col, sid_col in self.scan():
+            for ts, val, sid in zip(ts_col, val_col, sid_col):
+                if wanted is not None and sid not in wanted:
+                    continue
+                if (start is not None and ts < start) or (end is not None and ts >= end):
+                    continue
+                batch[0].append(ts)
+                batch[1].append(val)
+                batch[2].append(sid)
+                if len(batch[0]) >= batch_rows:
+                    yield batch
+                    batch = ([], [], [])
+        if batch[0]:
+            yield batch
+
+    def aggregate(self, series_ids=None, start=None, end=None):
+        """
+        Compute count/min/max/mean over the given series and [start, end) time range.
+        Any of the filters may be None to leave that dimension unbounded.
+        Uses numpy reductions per segment when it is installed.
+        """
+        count = 0
+        total = 0.0
+        low = high = None
+        np = optional_import("numpy")
+        if np is not None:
+            wanted = None if series_ids is None else np.array(sorted(set(series_ids)), dtype=np.int32)
+            for columns in self.scan():
+                val = self._matching(np, columns, wanted, start, end)[1]
+                if not len(val):
+                    continue
+                count += len(val)
+                total += float(val.sum())
+                low = float(val.min()) if low is None else min(low, float(val.min()))
+                high = float(val.max()) if high is None else max(high, float(val.max()))
+        else:
+            wanted = None if series_ids is None else set(series_ids)
+            for ts_col, val_col, sid_col in self.scan():
+                for ts, val, sid in zip(ts_col, val_col, sid_col):
+                    if wanted is not None and sid not in wanted:
+                        continue
+                    if (start is not None and ts < start) or (end is not None and ts >= end):
+                        continue
+                    count += 1
+                    total += val
+                    if low is None or val < low:
+                        low = val
+                    if high is None or val > high:
+                        high = val
+        return {
+            "count": count,
+            "min": low,
+            "max": high,
+            "mean": total / count if count else None,
+        }
+
+    def prefetch(self):
+        with self.lock:
+            segments = list(self.segments)
+        for segment in segments:
+            segment.prefetch()
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
+            for log in (self._wal, self._series_log):
+                if log is not None:
+                    log.close()
+            self._wal = self._series_log = None
+
+    def clear(self):
+        """
+        Drop every series and reading, including the files under data_dir.
+        """
+        self.close()
+        with self.lock:
+            if os.path.isdir(self.data_dir):
+                for entry in os.listdir(self.data_dir):
+                    if entry.startswith(("segment-", "active-")) or entry == "series.jsonl":
+                        os.remove(os.path.join(self.data_dir, entry))
+            self.series = []
+            self.series_ids = {}
+            self.room_series = {}
+            self._reset_active()
+
+##################################
+# ANOMALY DETECTION
+##################################
+ANOMALY_WARMUP = 10               # readings before a series can be scored
+ANOMALY_EWMA_ALPHA = 0.1
+ANOMALY_Z_THRESHOLD = 4.0         # |rolling z-score| above this is a spike
+ANOMALY_STUCK_REPEATS = 30        # identical consecutive readings for "stuck"
+ANOMALY_SILENT_MS = 15 * 60 * 1000
+ANOMALY_SWEEP_INTERVAL = 60       # seconds
+
+# Index = value of the `flag` column
+ANOMALY_REASONS = (None, "spike", "stuck", "silent")
+
+class AnomalyDetector:
+    """
+    Online statistics for every sensor series, kept in flat arrays indexed
+    by series id (a few dozen bytes per series):
+      - Welford running mean / variance over the series' whole history
+      - EWMA mean / variance, giving a rolling z-score for each reading
+      - consecutive identical readings, for stuck sensors
+    update() is O(1) per reading and flags spikes and stuck sensors;
+    sweep() rescores every series at once and also flags silent ones.
+    """
+    FLOAT_COLUMNS = ("mean", "m2", "ewma", "ewvar", "last", "zscore")
+    INT_COLUMNS = ("count", "repeats", "last_ts")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_sweep = 0.0
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            for column in self.FLOAT_COLUMNS:
+                setattr(self, column, array("d"))
+            for column in self.INT_COLUMNS:
+                setattr(self, column, array("q"))
+            self.flag = array("b")
+
+    def _ensure(self, sid):
+        missing = sid + 1 - len(self.flag)
+        if missing <= 0:
+            return
+        for column in self.FLOAT_COLUMNS:
+            getattr(self, column).extend(array("d", [0.0]) * missing)
+        for column in self.INT_COLUMNS:
+            getattr(self, column).extend(array("q", [0]) * missing)
+        self.flag.extend(array("b", [0]) * missing)
+
+    def update(self, sid, ts, value):
+        with self.lock:
+            self._ensure(sid)
+            n = self.count[sid] + 1
+            self.count[sid] = n
+
+            # Welford
+            delta = value - self.mean[sid]
+            self.mean[sid] += delta / n
+            self.m2[sid] += delta * (value - self.mean[sid])
+
+            # Rolling z-score against the EWMA state before this reading
+            ewma = self.ewma[sid]
+            ewvar = self.ewvar[sid]
+            if n > ANOMALY_WARMUP and ewvar > 0:
+                self.zscore[sid] = (value - ewma) / math.sqrt(ewvar)
+            else:
+                self.zscore[sid] = 0.0
+            if n == 1:
+                self.ewma[sid] = value
+            else:
+                diff = value - ewma
+                increment = ANOMALY_EWMA_ALPHA * diff
+                self.ewma[sid] = ewma + increment
+                self.ewvar[sid] = (1 - ANOMALY_EWMA_ALPHA) * (ewvar + diff * increment)
+
+            if n > 1 and value == self.last[sid]:
+                self.repeats[sid] += 1
+            else:
+                self.repeats[sid] = 1
+            self.last[sid] = value
+            self.last_ts[sid] = ts
+            self.flag[sid] = self._score(sid)
+
+    def _score(self, sid, now=None):
+        if self.repeats[sid] >= ANOMALY_STUCK_REPEATS:
+            return 2
+        if self.count[sid] > ANOMALY_WARMUP and abs(self.zscore[sid]) > ANOMALY_Z_THRESHOLD:
+            return 1
+        if now is not None and self.count[sid] and now - self.last_ts[sid] > ANOMALY_SILENT_MS:
+            return 3
+        return 0
+
+    def sweep(self, now=None):
+        """
+        Rescore every series at `now` (ms). Uses numpy over the arrays
+        in place when it is installed, a single plain pass otherwise.
+        """
+        if now is None:
+            now = int(time.time() * 1000)
+        with self.lock:
+            self.last_sweep = time.monotonic()
+            if not self.flag:
+                return
+            np = optional_import("numpy")
+            if np is None:
+                for sid in range(len(self.flag)):
+                    self.flag[sid] = self._score(sid, now)
+                return
+
+            count = np.frombuffer(self.count, dtype=np.int64)
+            repeats = np.frombuffer(self.repeats, dtype=np.int64)
+            last_ts = np.frombuffer(self.last_ts, dtype=np.int64)
+            zscore = np.frombuffer(self.zscore, dtype=np.float64)
+            scores = np.zeros(len(count), dtype=np.int8)
+            scores[(count > 0) & (now - last_ts > ANOMALY_SILENT_MS)] = 3
+            scores[(count > ANOMALY_WARMUP) & (np.abs(zscore) > ANOMALY_Z_THRESHOLD)] = 1
+            scores[repeats >= ANOMALY_STUCK_REPEATS] = 2
+            np.frombuffer(self.flag, dtype=np.int8)[:] = scores
+            # Release the buffer exports so the arrays can grow again
+            del count, repeats, last_ts, zscore
+
+    def maybe_sweep(self):
+        if time.monotonic() - self.last_sweep >= ANOMALY_SWEEP_INTERVAL:
+            self.sweep()
+
+    def anomalies(self, series_ids):
+        """
+        Return the state of every anomalous series among `series_ids`.
+        """
+        result = []
+        with self.lock:
+            for sid in series_ids:
+                if sid >= len(self.flag) or not self.flag[sid]:
+                    continue
+                n = self.count[sid]
+                result.append({
+                    "sid": sid,
+                    "reason": ANOMALY_REASONS[self.flag[sid]],
+                    "value": self.last[sid],
+                    "timestamp": self.last_ts[sid],
+                    "zscore": self.zscore[sid],
+                    "mean": self.mean[sid],
+                    "std": math.sqrt(self.m2[sid] / (n - 1)) if n > 1 else 0.0,
+                })
+        return result
+
+@app.route('/house/anomalies', methods=['POST'])
+def house_anomalies():
     """
     Required JSON fields:
-      - name
-      - lat
-      - lon
-      - addr
-      - uid
-      - floors
-      - size
+      - house_uid
+    Lists the devices of the house whose sensor series are currently anomalous.
     """
     data = request.get_json(force=True, silent=True)
     if not data:
         return make_error_response("Invalid or missing JSON.")
 
-    required = ["name", "lat", "lon", "addr", "uid", "floors", "size"]
+    required = ["house_uid"]
     valid, error = check_required_fields(data, required)
     if not valid:
         return make_error_response(error)
+    valid, error = check_string_fields(data, required)
+    if not valid:
+        return make_error_response(error)
+
+    result = []
+    for shard, series_ids in storage.sensor_scopes(storage.rooms_of(data["house_uid"])):
+        shard.anomalies.maybe_sweep()
+        for anomaly in shard.anomalies.anomalies(series_ids):
+            belong_to_room, name, sensor_type = shard.sensors.series[anomaly.pop("sid")]
+            result.append({"belong_to_room": belong_to_room, "name": name,
+                           "sensor_type": sensor_type, **anomaly})
+    return jsonify({"message": "House anomalies query success.", "data": result}), 200
+
+##################################
+# ENTITY STORAGE
+##################################
+# table -> (entity label, key fields)
+ENTITY_TABLES = {
+    "houses": ("House", ("uid",)),
+    "rooms": ("Room", ("belong_to_house", "name")),
+    "devices": ("Device", ("belong_to_room", "name")),
+    "users": ("User", ("user_id",)),
+    "house_users": ("House-User relation", ("house_uid", "user_id")),
+}
+
+class ConflictError(Exception):
+    """
+    Raised when a write conflicts with stored data (e.g. adding an existing entity).
+    `index` is set to the position of the failing change in its transaction.
+    """
+    index = None
+
+class EntityStore:
+    """
+    Tables of houses, rooms, devices, users and house-user links.
+    Writers hold `lock`, apply (table, action, data) changes with apply(),
+    undo them with rollback() on failure and make them durable with
+    journal() (see ShardedStorage.transaction). If `journal_path` is set,
+    each journal() call appends a single JSON line to it and the journal
+    is replayed on startup.
+    Lines written for a cross-shard transaction carry its id and are only
+    replayed if the id is in `committed`.
+    """
+    def __init__(self, journal_path=None, committed=()):
+        self.journal_path = journal_path
+        self.committed = committed
+        self.tables = {table: {} for table in ENTITY_TABLES}
+        # house uid -> set of room names, used to resolve house-wide sensor exports
+        self.house_rooms = {}
+        self.lock = threading.RLock()
+        self._load()
+
+    def _load(self):
+        if not self.journal_path or not os.path.exists(self.journal_path):
+            return
+        # A torn last line is a transaction that never committed
+        for entry in read_json_lines(self.journal_path):
+            if isinstance(entry, dict):
+                # Part of a cross-shard transaction: only replayed once committed
+                if entry["tx"] not in self.committed:
+                    continue
+                entry = entry["changes"]
+            for table, action, data in entry:
+                self.apply(table, action, data, [])
+
+    def apply(self, table, action, data, undo):
+        """
+        Apply one change in memory, where action is "add", "update" or
+        "remove", and append what it replaced to `undo`.
+        Raises ConflictError when adding an existing record.
+        """
+        entity, key_fields = ENTITY_TABLES[table]
+        key = tuple(str(data[field]) for field in key_fields)
+        old = self.tables[table].get(key)
+        if action == "add":
+            if old is not None:
+                raise ConflictError(f"{entity} '{'/'.join(key)}' already exists.")
+            record = dict(data)
+        elif action == "update":
+            if old is None:
+                return
+            record = {**old, **data}
+        else:
+            if old is None:
+                return
+            record = None
+        undo.append((table, key, old))
+        self._write(table, key, record)
+
+    def rollback(self, undo):
+        """
+        Revert the changes recorded in `undo`, newest first.
+        """
+        for table, key, old in reversed(undo):
+            self._write(table, key, old)
+
+    def journal(self, changes, tx=None):
+        """
+        Durably append applied changes to the journal, tagged with
+        cross-shard transaction id `tx` if given.
+        """
+        if self.journal_path and changes:
+            entry = changes if tx is None else {"tx": tx, "changes": changes}
+            with open(self.journal_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _write(self, table, key, record):
+        rows = self.tables[table]
+        if record is None:
+            rows.pop(key, None)
+        else:
+            rows[key] = record
+        if table == "rooms":
+            house, name = key
+            if record is None:
+                self.house_rooms.get(house, set()).discard(name)
+            else:
+                self.house_rooms.setdefault(house, set()).add(name)
+
+    def rooms_of(self, house_uid):
+        """
+        Return the names of the rooms stored for a house.
+        """
+        with self.lock:
+            return list(self.house_rooms.get(house_uid, ()))
+
+    def query(self, table, filters):
+        """
+        Return copies of the records in `table` whose fields equal every filter.
+        """
+        if not isinstance(filters, dict):
+            filters = {}
+        with self.lock:
+            return [
+                dict(record) for record in self.tables[table].values()
+                if all(record.get(field) == value for field, value in filters.items())
+            ]
+
+    def clear(self):
+        """
+        Drop every record, including the journal.
+        """
+        with self.lock:
+            for rows in self.tables.values():
+                rows.clear()
+            self.house_rooms.clear()
+            if self.journal_path and os.path.exists(self.journal_path):
+                os.truncate(self.journal_path, 0)
 
-    # Validate lat/lon
+##################################
+# SHARDING
+##################################
+STORAGE_SHARDS = int(os.environ.get("STORAGE_SHARDS", 4))
+
+# table -> field holding the partition key; devices are routed through their room
+PARTITION_KEYS = {
+    "houses": "uid",
+    "rooms": "belong_to_house",
+    "house_users": "house_uid",
+    "users": "user_id",  # users do not belong to a house; spread by id
+}
+
+class Shard:
+    """
+    Everything stored for one partition of the houses: entities, sensor
+    segments and anomaly statistics, each with its own files on disk.
+    Nothing is read until load() is called (see ShardedStorage.shard).
+    """
+    def __init__(self, index, data_dir, journal_path=None):
+        self.index = index
+        self.data_dir = data_dir
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.entities = None
+        self.sensors = None
+        self.anomalies = None
+
+    def load(self, on_load=None, committed=()):
+        """
+        Replay the journal and open the sensor segments, once.
+        `committed` holds the ids of committed cross-shard transactions;
+        `on_load(shard)` runs before the shard is marked as loaded.
+        """
+        with self.lock:
+            if self.loaded:
+                return
+            self.entities = EntityStore(self.journal_path, committed)
+            self.sensors = SensorStore(self.data_dir)
+            self.anomalies = AnomalyDetector()
+            if on_load:
+                on_load(self)
+            self.loaded = True
+
+class ShardedStorage:
+    """
+    Router hash-partitioning storage and sensor ingestion by house uid.
+    Rooms and house-user links follow their house; devices and sensor
+    reports follow their room (see room_shard). Per-house
+    operations therefore touch a single shard, while *_query calls without
+    a partition key fan out to every shard in parallel and merge results.
+    Shards are loaded on first use; warm_up() loads the rest in the background.
+
+    Every room is pinned to one shard the first time it is added or receives
+    data, and the pin is never changed: a room that reports before it is
+    added keeps its readings and devices together. Pins are persisted in
+    `rooms.jsonl` under data_dir. Room names are unique across houses: the
+    first house to add a room owns its name for good, so removing the room
+    does not hand its devices and readings to another house.
+    """
+    def __init__(self, shards, data_dir, journal_path=None):
+        self.data_dir = data_dir
+        self.journal_path = journal_path
+        self.shards = [
+            Shard(index, os.path.join(data_dir, f"shard-{index}"),
+                  f"{journal_path}.{index}" if journal_path else None)
+            for index in range(shards)
+        ]
+        self.executor = ThreadPoolExecutor(max_workers=shards, thread_name_prefix="shard")
+        # Ids of committed cross-shard transactions; read on first shard load
+        self.commit_log_path = f"{journal_path}.commits" if journal_path else None
+        self.committed = None
+        self.commit_lock = threading.Lock()
+        # room name -> pinned shard index
+        self.room_shards = {}
+        self.room_index_path = os.path.join(data_dir, "rooms.jsonl")
+        # Serializes pinning and room ownership checks
+        self.routing_lock = threading.RLock()
+        # room name -> owning house uid, to check room names are unique.
+        # Persisted in the room index; rooms journaled before their owner
+        # was recorded are filled in as shards load.
+        self.room_houses = {}
+        self.warm = False
+        self._load_room_index()
+        # Set once the shard count is on disk; written with the first write
+        self.layout_recorded = self._check_layout()
+        self.layout_lock = threading.Lock()
+
+    def _layout_paths(self):
+        paths = [os.path.join(self.data_dir, "storage.json")]
+        if self.journal_path:
+            paths.append(f"{self.journal_path}.layout")
+        return paths
+
+    def _check_layout(self):
+        """
+        Refuse to open data written with a different shard count than the
+        one recorded next to the sensor data and the journals (every key
+        would hash to another shard).
+        Returns whether the count is recorded in every place.
+        Raises RuntimeError if the data cannot be used.
+        """
+        paths = self._layout_paths()
+        recorded = []
+        for path in paths:
+            if os.path.exists(path):
+                with open(path) as f:
+                    recorded.append((path, json.load(f)["shards"]))
+        for path, shards in recorded:
+            if shards != len(self.shards):
+                raise RuntimeError(f"{path} records {shards} storage shards, but "
+                                   f"{len(self.shards)} are configured (STORAGE_SHARDS).")
+        if len(recorded) == len(paths):
+            return True
+        self._check_stray_shards()
+        return False
+
+    def _record_layout(self):
+        """
+        Record the shard count before the first write, so opening storage
+        (e.g. on `import app`) leaves no files behind.
+        """
+        if self.layout_recorded:
+            return
+        with self.layout_lock:
+            if self.layout_recorded:
+                return
+            for path in self._layout_paths():
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                with open(path, "w") as f:
+                    json.dump({"shards": len(self.shards)}, f)
+            self.layout_recorded = True
+
+    def _check_stray_shards(self):
+        """
+        Refuse shard files beyond the configured count, left by data written
+        before the count was recorded.
+        """
+        stray = []
+        if os.path.isdir(self.data_dir):
+            for entry in os.listdir(self.data_dir):
+                if entry.startswith("shard-"):
+                    stray.append(entry[len("shard-"):])
+        journal_dir, journal_name = os.path.split(self.journal_path or "")
+        if journal_name and os.path.isdir(journal_dir or "."):
+            for entry in os.listdir(journal_dir or "."):
+                if entry.startswith(journal_name + "."):
+                    stray.append(entry[len(journal_name) + 1:])
+        if any(suffix.isdigit() and int(suffix) >= len(self.shards) for suffix in stray):
+            raise RuntimeError(f"Storage holds more than {len(self.shards)} shards; "
+                               "set STORAGE_SHARDS to the count it was written with.")
+
+    def _load_room_index(self):
+        if not os.path.exists(self.room_index_path):
+            return
+        # [room, shard] pins a room; [room, shard, house] records its owner
+        for entry in read_json_lines(self.room_index_path):
+            # The first pin of a room is the one its data was written under
+            self.room_shards.setdefault(entry[0], entry[1])
+            if len(entry) > 2:
+                self.room_houses.setdefault(entry[0], entry[2])
+
+    def _pin_room(self, room, index):
+        """
+        Pin `room` to shard `index` unless it is already pinned.
+        Returns the room's shard index. The pin is on disk before any data
+        is written under it.
+        """
+        with self.routing_lock:
+            pinned = self.room_shards.get(room)
+            if pinned is not None:
+                return pinned
+            self._append_room_index([[room, index]])
+            self.room_shards[room] = index
+            return index
+
+    def _own_rooms(self, owners):
+        """
+        Record the owning house of each room in `owners` (name -> house uid)
+        in the room index. Called with routing_lock held.
+        """
+        if owners:
+            self._append_room_index([[name, self.room_shard(name), house]
+                                     for name, house in owners.items()])
+            self.room_houses.update(owners)
+
+    def _append_room_index(self, entries):
+        self._record_layout()
+        os.makedirs(os.path.dirname(self.room_index_path), exist_ok=True)
+        with open(self.room_index_path, "a") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def shard(self, index):
+        """
+        Return shard `index`, loading it on first use.
+        """
+        shard = self.shards[index]
+        if not shard.loaded:
+            shard.load(self._register_rooms, self.committed_transactions())
+        return shard
+
+    def committed_transactions(self):
+        with self.commit_lock:
+            if self.committed is None:
+                self.committed = set()
+                if self.commit_log_path and os.path.exists(self.commit_log_path):
+                    self.committed.update(read_json_lines(self.commit_log_path))
+            return self.committed
+
+    def _commit(self, tx):
+        """
+        Durably mark cross-shard transaction `tx` as committed.
+        """
+        with self.commit_lock:
+            with open(self.commit_log_path, "a") as f:
+                f.write(json.dumps(tx) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.committed.add(tx)
+
+    def _register_rooms(self, shard):
+        for house, name in shard.entities.tables["rooms"]:
+            self.room_houses.setdefault(name, house)
+
+    def loaded_shards(self):
+        return [shard for shard in self.shards if shard.loaded]
+
+    def shard_index(self, key):
+        # crc32 rather than hash(): stable across processes and restarts
+        return zlib.crc32(str(key).encode()) % len(self.shards)
+
+    def room_shard(self, room, pin=False):
+        """
+        Return the shard index of a room. Rooms that were never pinned map to
+        the shard of their own name; with `pin` (when data is about to be
+        written for the room) that mapping is pinned.
+        """
+        room = str(room)
+        index = self.room_shards.get(room)
+        if index is None:
+            index = self.shard_index(room)
+            if pin:
+                index = self._pin_room(room, index)
+        return index
+
+    def house_of_room(self, room):
+        """
+        Return the uid of the house that owns a room name, or None.
+        Owners come from the room index; only a pinned room without one
+        (it reported before being added, or was added just before a crash)
+        loads its shard to check.
+        """
+        room = str(room)
+        owner = self.room_houses.get(room)
+        if owner is None and room in self.room_shards:
+            self.shard(self.room_shards[room])
+            owner = self.room_houses.get(room)
+        return owner
+
+    def shard_for_house(self, house_uid):
+        return self.shard(self.shard_index(house_uid))
+
+    def shard_for_room(self, room, pin=False):
+        return self.shard(self.room_shard(room, pin))
+
+    def sensor_scopes(self, rooms, name=None):
+        """
+        Return (shard, series ids) pairs covering the series of the given rooms,
+        optionally restricted to a single device name.
+        """
+        by_shard = {}
+        for room in rooms:
+            by_shard.setdefault(self.room_shard(room), []).append(room)
+        scopes = []
+        for index, shard_rooms in sorted(by_shard.items()):
+            shard = self.shard(index)
+            scopes.append((shard, shard.sensors.series_ids_for(shard_rooms, name)))
+        return scopes
+
+    def _route(self, table, action, data):
+        if table == "devices":
+            return self.room_shard(data["belong_to_room"], pin=action == "add")
+        return self.shard_index(data[PARTITION_KEYS[table]])
+
+    def _claim_rooms(self, changes):
+        """
+        Check that every room added by `changes` is free or already belongs
+        to the same house, and pin new rooms to their house's shard.
+        Returns the owners of the added rooms (name -> house uid), to be
+        recorded once they are committed. Rooms being removed have their owner
+        recorded right away, so the name stays reserved after the room is gone.
+        Raises ConflictError otherwise. Called with routing_lock held.
+        """
+        owners = {}
+        for position, (table, action, data) in enumerate(changes):
+            if table != "rooms" or action not in ("add", "remove"):
+                continue
+            name = data["name"]
+            house = data["belong_to_house"]
+            owner = owners[name] if name in owners else self.house_of_room(name)
+            if action == "remove":
+                if owner == house and name not in owners:
+                    self._own_rooms({name: house})
+                continue
+            if owner is not None and owner != house:
+                e = ConflictError(f"Room '{name}' already belongs to house '{owner}'.")
+                e.index = position
+                raise e
+            owners[name] = house
+            self._pin_room(name, self.shard_index(house))
+        return owners
+
+    def transaction(self, changes):
+        """
+        Apply (table, action, data) changes all-or-nothing across shards.
+        Involved shards are locked in index order (so concurrent
+        transactions cannot deadlock); on failure every shard is rolled back.
+        Transactions adding or removing rooms also hold routing_lock, so two
+        houses cannot claim the same room name concurrently.
+        """
+        has_rooms = any(table == "rooms" for table, _, _ in changes)
+        with self.routing_lock if has_rooms else nullcontext():
+            owners = self._claim_rooms(changes) if has_rooms else {}
+            routed = [self._route(table, action, data) for table, action, data in changes]
+
+            involved = sorted(set(routed))
+            for index in involved:
+                self.shard(index)
+            undo = {index: [] for index in involved}
+            with ExitStack() as stack:
+                for index in involved:
+                    stack.enter_context(self.shards[index].entities.lock)
+                try:
+                    for position, (index, (table, action, data)) in enumerate(zip(routed, changes)):
+                        try:
+                            self.shards[index].entities.apply(table, action, data, undo[index])
+                        except ConflictError as e:
+                            e.index = position
+                            raise
+                    self._journal(involved, routed, changes)
+                except Exception:
+                    for index in involved:
+                        self.shards[index].entities.rollback(undo[index])
+                    raise
+
+            self._own_rooms(owners)
+
+    def _journal(self, involved, routed, changes):
+        """
+        Journal a transaction's changes in each involved shard. A transaction
+        spanning several shards is tagged with an id and only counts as
+        committed once that id is in the coordinator's commit log, so a
+        failure part way through leaves nothing that would be replayed.
+        """
+        if self.journal_path:
+            self._record_layout()
+        if len(involved) == 1:
+            self.shards[involved[0]].entities.journal(changes)
+            return
+        tx = uuid.uuid4().hex if self.commit_log_path else None
+        for index in involved:
+            self.shards[index].entities.journal(
+                [change for shard, change in zip(routed, changes) if shard == index], tx)
+        if tx is not None:
+            self._commit(tx)
+
+    def query(self, table, filters):
+        if not isinstance(filters, dict):
+            filters = {}
+        key_field = PARTITION_KEYS.get(table)
+        if key_field in filters:
+            shards = [self.shard_for_house(filters[key_field])]
+        elif table == "devices" and "belong_to_room" in filters:
+            shards = [self.shard_for_room(filters["belong_to_room"])]
+        else:
+            shards = [self.shard(index) for index in range(len(self.shards))]
+        if len(shards) == 1:
+            return shards[0].entities.query(table, filters)
+        parts = self.executor.map(lambda shard: shard.entities.query(table, filters), shards)
+        return [record for part in parts for record in part]
+
+    def rooms_of(self, house_uid):
+        return self.shard_for_house(house_uid).entities.rooms_of(house_uid)
+
+    def sweep_anomalies(self):
+        # Shards that were never loaded have no anomaly state yet
+        list(self.executor.map(lambda shard: shard.anomalies.sweep(), self.loaded_shards()))
+
+    def run_anomaly_sweeper(self, interval=ANOMALY_SWEEP_INTERVAL):
+        """
+        Sweep every shard forever every `interval` seconds; meant for a daemon thread.
+        """
+        while True:
+            time.sleep(interval)
+            self.sweep_anomalies()
+
+    def start_sweeper(self):
+        thread = threading.Thread(target=self.run_anomaly_sweeper, name="anomaly-sweeper", daemon=True)
+        thread.start()
+        return thread
+
+    def warm_up(self):
+        """
+        Load every shard and prefetch its sensor segments into the page cache.
+        """
+        for index in range(len(self.shards)):
+            self.shard(index).sensors.prefetch()
+        self.warm = True
+
+    def start_warmup(self):
+        thread = threading.Thread(target=self.warm_up, name="storage-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def progress(self):
+        loaded = len(self.loaded_shards())
+        return {
+            "warm": self.warm,
+            "shards_loaded": loaded,
+            "shards": len(self.shards),
+            "progress": loaded / len(self.shards),
+        }
+
+    def clear(self):
+        for index in range(len(self.shards)):
+            shard = self.shard(index)
+            shard.entities.clear()
+            shard.anomalies.clear()
+            shard.sensors.clear()
+        with self.commit_lock:
+            self.committed = set()
+            if self.commit_log_path and os.path.exists(self.commit_log_path):
+                os.truncate(self.commit_log_path, 0)
+        with self.routing_lock:
+            self.room_houses.clear()
+            self.room_shards.clear()
+            if os.path.exists(self.room_index_path):
+                os.truncate(self.room_index_path, 0)
+
+storage = ShardedStorage(STORAGE_SHARDS, os.environ.get("SENSOR_DATA_DIR", "sensor_data"),
+                         os.environ.get("ENTITY_JOURNAL"))
+# Requests are served right away; shards they touch load on demand meanwhile
+storage.start_warmup()
+storage.start_sweeper()
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    Readiness probe with warm-up progress. Answers 200 as soon as requests
+    can be served (shards load on demand); with ?warm=1 it answers 503
+    until every shard has been loaded and prefetched.
+    """
+    progress = storage.progress()
+    if request.args.get("warm") and not progress["warm"]:
+        return jsonify({"message": "Warming up.", **progress}), 503
+    return jsonify({"message": "Ready.", **progress}), 200
+
+def require_fields(data, required_fields):
+    """
+    Like check_required_fields, but raises ValueError for the first missing field.
+    """
+    valid, error = check_required_fields(data, required_fields)
+    if not valid:
+        raise ValueError(error)
+
+def validate_operation(op, data):
+    """
+    Check the payload of one registered operation (see OPERATIONS).
+    Raises ValueError if it is not a JSON object, fails the op's validator,
+    or has a non-string key field (records are keyed by these fields).
+    """
+    validator, table, _, _, _ = OPERATIONS[op]
+    if not isinstance(data, dict) or not data:
+        raise ValueError("Invalid or missing JSON.")
+    validator(data)
+    valid, error = check_string_fields(data, ENTITY_TABLES[table][1])
+    if not valid:
+        raise ValueError(error)
+
+def run_operation(op, data):
+    """
+    Validate and apply one registered operation (see OPERATIONS).
+    Returns a Flask response: 400 on invalid input, 409 on a conflict.
+    """
+    _, table, action, message, status = OPERATIONS[op]
     try:
-        validate_lat_lon(data["lat"], data["lon"])
+        validate_operation(op, data)
     except ValueError as e:
         return make_error_response(str(e))
 
-    # Validate floors and size
     try:
-        floors = validate_int_positive(data["floors"], "floors")
-        size = validate_int_positive(data["size"], "size")
-    except ValueError as e:
-        return make_error_response(str(e))
+        storage.transaction([(table, action, data)])
+    except ConflictError as e:
+        return make_error_response(str(e), 409)
+    return jsonify({"message": message}), status
+
+##################################
+# HOUSE
+##################################
+def validate_house_add(data):
+    require_fields(data, ["name", "lat", "lon", "addr", "uid", "floors", "size"])
+    validate_lat_lon(data["lat"], data["lon"])
+    validate_int_positive(data["floors"], "floors")
+    validate_int_positive(data["size"], "size")
+
+def validate_house_remove(data):
+    require_fields(data, ["uid"])
+
+def validate_house_update(data):
+    # Must have uid
+    require_fields(data, ["uid"])
+
+    # Validate lat/lon if provided
+    if "lat" in data or "lon" in data:
+        # Both must be present if updating lat/lon
+        if "lat" not in data or "lon" not in data:
+            raise ValueError("Both 'lat' and 'lon' must be provided if updating them.")
+        validate_lat_lon(data["lat"], data["lon"])
+
+    # Validate floors and size if provided
+    if "floors" in data:
+        validate_int_positive(data["floors"], "floors")
+    if "size" in data:
+        validate_int_positive(data["size"], "size")
+
+@app.route('/house/add', methods=['POST'])
+@idempotent()
+def house_add():
+    """
+    Required JSON fields:
+      - name
+      - lat
+      - lon
+      - addr
+      - uid
+      - floors
+      - size
+    """
+    data = request.get_json(force=True, silent=True)
+    if not data:
+        return make_error_response("Invalid or missing JSON.")
 
-    # If everything is OK:
-    return jsonify({"message": "House added successfully."}), 201
+    return run_operation("house/add", data)
 
 @app.route('/house/remove', methods=['POST'])
 def house_remove():
@@ -104,12 +1521,7 @@ def house_remove():
     if not data:
         return make_error_response("Invalid or missing JSON.")
 
-    required = ["uid"]
-    valid, error = check_required_fields(data, required)
-    if not valid:
-        return make_error_response(error)
-
-    return jsonify({"message": "House removed successfully."}), 200
+    return run_operation("house/remove", data)
 
 @app.route('/house/update', methods=['POST'])
 def house_update():
@@ -128,35 +1540,7 @@ def house_update():
     if not data:
         return make_error_response("Invalid or missing JSON.")
 
-    # Must have uid
-    if "uid" not in data:
-        return make_error_response("'uid' is required.")
-
-    # Validate lat/lon if provided
-    if "lat" in data or "lon" in data:
-        # Both must be present if updating lat/lon
-        if "lat" not in data or "lon" not in data:
-            return make_error_response("Both 'lat' and 'lon' must be provided if updating them.")
-        try:
-            validate_lat_lon(data["lat"], data["lon"])
-        except ValueError as e:
-            return make_error_response(str(e))
-
-    # Validate floors if provided
-    if "floors" in data:
-        try:
-            _ = validate_int_positive(data["floors"], "floors")
-        except ValueError as e:
-            return make_error_response(str(e))
-
-    # Validate size if provided
-    if "size" in data:
-        try:
-            _ = validate_int_positive(data["size"], "size")
-        except ValueError as e:
-            return make_error_response(str(e))
-
-    return jsonify({"message": "House updated successfully."}), 200
+    return run_operation("house/update", data)
 
 @app.route('/house/query', methods=['POST'])
 def house_query():
@@ -170,12 +1554,28 @@ def house_query():
     in the JSON body.
     """
     data = request.get_json(force=True, silent=True) or {}
-    # Typically you'd filter storage based on these params
-    return jsonify({"message": "House query success.", "data": []}), 200
+    return jsonify({"message": "House query success.", "data": storage.query("houses", data)}), 200
 
 ##################################
 # ROOM
 ##################################
+def validate_room_add(data):
+    require_fields(data, ["name", "belong_to_house", "size", "floor"])
+    validate_int_positive(data["size"], "size")
+    validate_int_positive(data["floor"], "floor")
+
+def validate_room_remove(data):
+    require_fields(data, ["name", "belong_to_house"])
+
+def validate_room_update(data):
+    require_fields(data, ["name", "belong_to_house"])
+
+    # Validate optional fields
+    if "size" in data:
+        validate_int_positive(data["size"], "size")
+    if "floor" in data:
+        validate_int_positive(data["floor"], "floor")
+
 @app.route('/room/add', methods=['POST'])
 def room_add():
     """
@@ -189,19 +1589,7 @@ def room_add():
     if not data:
         return make_error_response("Invalid or missing JSON.")
 
-    required = ["name", "belong_to_house", "size", "floor"]
-    valid, error = check_required_fields(data, required)
-    if not valid:
-        return make_error_response(error)
-
-    # Example additional checks
-    try:
-        size = validate_int_positive(data["size"], "size")
-        floor = validate_int_positive(data["floor"], "floor")
-    except ValueError as e:
-        return make_error_response(str(e))
-
-    return jsonify({"message": "Room added successfully."}), 201
+    return run_operation("room/add", data)
 
 @app.route('/room/remove', methods=['POST'])
 def room_remove():
@@ -214,12 +1602,7 @@ def room_remove():
     if not data:
         return make_error_response("Invalid or missing JSON.")
 
-    required = ["name", "belong_to_house"]
-    valid, error = check_required_fields(data, required)
-    if not valid:
-        return make_error_response(error)
-
-    return jsonify({"message": "Room removed successfully."}), 200
+    return run_operation("room/remove", data)
 
 @app.route('/room/update', methods=['POST'])
 def room_update():
@@ -235,25 +1618,7 @@ def room_update():
     if not data:
         return make_error_response("Invalid or missing JSON.")
 
-    required = ["name", "belong_to_house"]
-    valid, error = check_required_fields(data, required)
-    if not valid:
-        return make_error_response(error)
-
-    # Validate optional fields
-    if "size" in data:
-        try:
-            _ = validate_int_positive(data["size"], "size")
-        except ValueError as e:
-            return make_error_response(str(e))
-
-    if "floor" in data:
-        try:
-            _ = validate_int_positive(data["floor"], "floor")
-        except ValueError as e:
-            return make_error_response(str(e))
-
-    return jsonify({"message": "Room updated successfully."}), 200
+    return run_operation("room/update", data)
 
 @app.route('/room/query', methods=['POST'])
 def room_query():
@@ -261,12 +1626,22 @@ def room_query():
     Should pass name and belong_to_house in the JSON if needed.
     """
     data = request.get_json(force=True, silent=True) or {}
-    return jsonify({"message": "Room query success.", "data": []}), 200
+    return jsonify({"message": "Room query success.", "data": storage.query("rooms", data)}), 200
 
 ##################################
 # DEVICE
 ##################################
+def validate_device_add(data):
+    require_fields(data, ["name", "belong_to_room", "type"])
+
+def validate_device_remove(data):
+    require_fields(data, ["name", "belong_to_room"])
+
+def validate_device_update(data):
+    require_fields(data, ["name", "belong_to_room"])
+
 @app.route('/device/add', methods=['POST'])
+@idempotent()
 def device_add():
     """
     Required JSON fields:
@@ -278,12 +1653,7 @@ def device_add():
     if not data:
         return make_error_response("Invalid or missing JSON.")
 
-    required = ["name", "belong_to_room", "type"]
-    valid, error = check_required_fields(data, required)
-    if not valid:
-        return make_error_response(error)
-
-    return jsonify({"message": "Device added successfully."}), 201
+    return run_operation("device/add", data)
 
 @app.route('/device/remove', methods=['POST'])
 def device_remove():
@@ -296,12 +1666,7 @@ def device_remove():
     if not data:
         return make_error_response("Invalid or missing JSON.")
 
-    required = ["name", "belong_to_room"]
-    valid, error = check_required_fields(data, required)
-    if not valid:
-        return make_error_response(error)
-
-    return jsonify({"message": "Device removed successfully."}), 200
+    return run_operation("device/remove", data)
 
 @app.route('/device/update', methods=['POST'])
 def device_update():
@@ -316,25 +1681,358 @@ def device_update():
     if not data:
         return make_error_response("Invalid or missing JSON.")
 
-    required = ["name", "belong_to_room"]
+    return run_operation("device/update", data)
+
+@app.route('/device/query', methods=['POST'])
+def device_query():
+    """
+    Can pass name, belong_to_room in the JSON if needed.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    return jsonify({"message": "Device query success.", "data": storage.query("devices", data)}), 200
+
+##################################
+# SENSOR TYPES
+##################################
+# sensor_type -> canonical unit, accepted range (in the canonical unit) and
+# accepted units as value * scale + offset conversions to the canonical unit.
+SENSOR_TYPES = {
+    "temperature": {"unit": "C", "min": -50.0, "max": 100.0,
+                    "units": {"C": (1.0, 0.0), "F": (5 / 9, -160 / 9), "K": (1.0, -273.15)}},
+    "humidity": {"unit": "%", "min": 0.0, "max": 100.0, "units": {"%": (1.0, 0.0)}},
+    "pressure": {"unit": "hPa", "min": 300.0, "max": 1100.0,
+                 "units": {"hPa": (1.0, 0.0), "kPa": (10.0, 0.0), "Pa": (0.01, 0.0)}},
+    "co2": {"unit": "ppm", "min": 0.0, "max": 10000.0, "units": {"ppm": (1.0, 0.0)}},
+    "light": {"unit": "lux", "min": 0.0, "max": 200000.0, "units": {"lux": (1.0, 0.0)}},
+    "power": {"unit": "W", "min": 0.0, "max": 100000.0,
+              "units": {"W": (1.0, 0.0), "kW": (1000.0, 0.0)}},
+    "motion": {"unit": "bool", "min": 0.0, "max": 1.0, "units": {"bool": (1.0, 0.0)},
+               "allow_bool": True},
+}
+
+def compile_sensor_validator(sensor_type, spec):
+    """
+    Build a validator for one sensor type. The returned function takes
+    (value, unit=None), coerces numeric strings (and booleans, where allowed)
+    to float, converts to the canonical unit and checks the range.
+    Returns the normalized value; raises ValueError if invalid.
+    """
+    low = spec["min"]
+    high = spec["max"]
+    canonical = spec["unit"]
+    units = dict(spec["units"])
+    allow_bool = spec.get("allow_bool", False)
+    range_error = f"'sensor_value' out of range for {sensor_type} ({low:g} to {high:g} {canonical})."
+
+    def validate(value, unit=None):
+        if isinstance(value, bool):
+            if not allow_bool:
+                raise ValueError("'sensor_value' must be a number.")
+            value = float(value)
+        elif isinstance(value, (int, float, str)):
+            try:
+                value = float(value)
+            except (ValueError, OverflowError):
+                # OverflowError: an int too large for a float, e.g. 10**400
+                raise ValueError("'sensor_value' must be a number.")
+        else:
+            raise ValueError("'sensor_value' must be a number.")
+
+        if unit is not None and unit != canonical:
+            conversion = units.get(unit) if isinstance(unit, str) else None
+            if conversion is None:
+                raise ValueError(f"Unknown unit '{unit}' for sensor_type '{sensor_type}'.")
+            scale, offset = conversion
+            value = value * scale + offset
+
+        # Written so that NaN fails the check too
+        if not low <= value <= high:
+            raise ValueError(range_error)
+        return value
+
+    return validate
+
+SENSOR_VALIDATORS = {
+    sensor_type: compile_sensor_validator(sensor_type, spec)
+    for sensor_type, spec in SENSOR_TYPES.items()
+}
+
+##################################
+# RULES
+##################################
+RULE_OPS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+RULE_AGGREGATES = ("avg", "min", "max")
+
+class SlidingWindow:
+    """
+    Readings of one (belong_to_room, sensor_type) over the last `span` ms.
+    Keeps a running sum plus monotonic min/max deques, so adding a reading
+    and reading avg/min/max are O(1) amortized. Timestamps must not decrease.
+    """
+    def __init__(self, span):
+        self.span = span
+        self.readings = deque()
+        self.mins = deque()
+        self.maxs = deque()
+        self.total = 0.0
+        self.started = None
+
+    def add(self, ts, value):
+        cutoff = ts - self.span
+        while self.readings and self.readings[0][0] < cutoff:
+            self.total -= self.readings.popleft()[1]
+        while self.mins and self.mins[0][0] < cutoff:
+            self.mins.popleft()
+        while self.maxs and self.maxs[0][0] < cutoff:
+            self.maxs.popleft()
+        if not self.readings:
+            # The window ran dry (or is new): coverage starts over
+            self.started = ts
+            self.total = 0.0
+
+        self.readings.append((ts, value))
+        self.total += value
+        while self.mins and self.mins[-1][1] > value:
+            self.mins.pop()
+        self.mins.append((ts, value))
+        while self.maxs and self.maxs[-1][1] < value:
+            self.maxs.pop()
+        self.maxs.append((ts, value))
+
+    def covered(self, ts):
+        """
+        True once readings have been arriving for at least the whole span.
+        """
+        return self.started is not None and ts - self.started >= self.span
+
+    def value(self, aggregate):
+        if aggregate == "min":
+            return self.mins[0][1]
+        if aggregate == "max":
+            return self.maxs[0][1]
+        return self.total / len(self.readings)
+
+class RuleEngine:
+    """
+    Threshold rules evaluated on every sensor report.
+    Rules are indexed by (belong_to_room, sensor_type), so a reading only
+    touches the rules of its own room and type. Rules on the same key and
+    window length share one SlidingWindow. While a rule holds, its house is
+    flagged; the flag is cleared as soon as the rule stops holding.
+    """
+    def __init__(self):
+        self.rules = {}
+        self.index = {}
+        self.windows = {}
+        self.flags = {}
+        self.lock = threading.Lock()
+
+    def add(self, rule):
+        with self.lock:
+            if rule["rule_id"] in self.rules:
+                raise ConflictError(f"Rule '{rule['rule_id']}' already exists.")
+            key = (rule["belong_to_room"], rule["sensor_type"])
+            span = int(rule["window"] * 1000)
+            self.rules[rule["rule_id"]] = rule
+            self.index.setdefault(key, {})[rule["rule_id"]] = (rule, span)
+            self.windows.setdefault(key, {}).setdefault(span, SlidingWindow(span))
+
+    def remove(self, rule_id):
+        with self.lock:
+            rule = self.rules.pop(rule_id, None)
+            if rule is None:
+                return
+            key = (rule["belong_to_room"], rule["sensor_type"])
+            rules = self.index[key]
+            _, span = rules.pop(rule_id)
+            if not rules:
+                del self.index[key]
+                del self.windows[key]
+            elif all(other_span != span for _, other_span in rules.values()):
+                del self.windows[key][span]
+            self.flags.get(rule["belong_to_house"], {}).pop(rule_id, None)
+
+    def evaluate(self, belong_to_room, sensor_type, ts, value):
+        """
+        Feed one reading to the matching rules; O(matching rules).
+        """
+        key = (belong_to_room, sensor_type)
+        if key not in self.index:
+            return
+        with self.lock:
+            rules = self.index.get(key)
+            if not rules:
+                return
+            windows = self.windows[key]
+            for window in windows.values():
+                window.add(ts, value)
+            for rule_id, (rule, span) in rules.items():
+                window = windows[span]
+                current = window.value(rule["aggregate"])
+                house_flags = self.flags.setdefault(rule["belong_to_house"], {})
+                if window.covered(ts) and RULE_OPS[rule["op"]](current, rule["threshold"]):
+                    house_flags[rule_id] = {
+                        "rule_id": rule_id,
+                        "belong_to_room": belong_to_room,
+                        "sensor_type": sensor_type,
+                        "value": current,
+                        "timestamp": ts,
+                    }
+                else:
+                    house_flags.pop(rule_id, None)
+
+    def query(self, filters):
+        if not isinstance(filters, dict):
+            filters = {}
+        with self.lock:
+            return [
+                dict(rule) for rule in self.rules.values()
+                if all(rule.get(field) == value for field, value in filters.items())
+            ]
+
+    def house_flags(self, house_uid):
+        with self.lock:
+            return [dict(flag) for flag in self.flags.get(house_uid, {}).values()]
+
+    def clear(self):
+        with self.lock:
+            self.rules.clear()
+            self.index.clear()
+            self.windows.clear()
+            self.flags.clear()
+
+rule_engine = RuleEngine()
+
+def finite_number(value):
+    """
+    Return value as a finite float, or None if it is not a finite number
+    (bools, NaN, +-Infinity and ints too large for a float included).
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    try:
+        value = float(value)
+    except OverflowError:
+        return None
+    return value if math.isfinite(value) else None
+
+def validate_rule_add(data):
+    require_fields(data, ["rule_id", "belong_to_house", "belong_to_room",
+                          "sensor_type", "op", "threshold"])
+    valid, error = check_string_fields(data, ["rule_id", "belong_to_house", "belong_to_room",
+                                              "sensor_type", "op", "aggregate"])
+    if not valid:
+        raise ValueError(error)
+    if data["sensor_type"] not in SENSOR_TYPES:
+        raise ValueError(f"Unknown sensor_type '{data['sensor_type']}'.")
+    if data["op"] not in RULE_OPS:
+        raise ValueError(f"'op' must be one of {', '.join(RULE_OPS)}.")
+    if data.get("aggregate", "avg") not in RULE_AGGREGATES:
+        raise ValueError(f"'aggregate' must be one of {', '.join(RULE_AGGREGATES)}.")
+    if finite_number(data["threshold"]) is None:
+        raise ValueError("'threshold' must be a finite number.")
+    window = finite_number(data.get("window", 0))
+    if window is None or window < 0:
+        raise ValueError("'window' must be a non-negative number of seconds.")
+
+@app.route('/rule/add', methods=['POST'])
+def rule_add():
+    """
+    Required JSON fields:
+      - rule_id
+      - belong_to_house (the house to flag)
+      - belong_to_room
+      - sensor_type
+      - op (one of RULE_OPS, e.g. ">")
+      - threshold (in the sensor type's canonical unit)
+    Optional fields:
+      - window (seconds, default 0: every reading on its own)
+      - aggregate (avg, min or max over the window, default avg)
+    "temperature > 30 for 5 minutes" is op ">", threshold 30,
+    window 300, aggregate "min".
+    """
+    data = request.get_json(force=True, silent=True)
+    if not data:
+        return make_error_response("Invalid or missing JSON.")
+
+    try:
+        validate_rule_add(data)
+    except ValueError as e:
+        return make_error_response(str(e))
+
+    rule = {field: data[field] for field in ("rule_id", "belong_to_house", "belong_to_room",
+                                             "sensor_type", "op", "threshold")}
+    rule["window"] = data.get("window", 0)
+    rule["aggregate"] = data.get("aggregate", "avg")
+    try:
+        rule_engine.add(rule)
+    except ConflictError as e:
+        return make_error_response(str(e), 409)
+    return jsonify({"message": "Rule added successfully."}), 201
+
+@app.route('/rule/remove', methods=['POST'])
+def rule_remove():
+    """
+    Required JSON fields:
+      - rule_id
+    """
+    data = request.get_json(force=True, silent=True)
+    if not data:
+        return make_error_response("Invalid or missing JSON.")
+
+    required = ["rule_id"]
     valid, error = check_required_fields(data, required)
+    if not valid:
+        return make_error_response(error)
+    valid, error = check_string_fields(data, required)
     if not valid:
         return make_error_response(error)
 
-    return jsonify({"message": "Device updated successfully."}), 200
+    rule_engine.remove(data["rule_id"])
+    return jsonify({"message": "Rule removed successfully."}), 200
 
-@app.route('/device/query', methods=['POST'])
-def device_query():
+@app.route('/rule/query', methods=['POST'])
+def rule_query():
     """
-    Can pass name, belong_to_room in the JSON if needed.
+    Can pass rule_id, belong_to_house, belong_to_room, sensor_type in the JSON if needed.
     """
     data = request.get_json(force=True, silent=True) or {}
-    return jsonify({"message": "Device query success.", "data": []}), 200
+    return jsonify({"message": "Rule query success.", "data": rule_engine.query(data)}), 200
+
+@app.route('/house/flags', methods=['POST'])
+def house_flags():
+    """
+    Required JSON fields:
+      - house_uid
+    Returns the rules currently holding for the house.
+    """
+    data = request.get_json(force=True, silent=True)
+    if not data:
+        return make_error_response("Invalid or missing JSON.")
+
+    required = ["house_uid"]
+    valid, error = check_required_fields(data, required)
+    if not valid:
+        return make_error_response(error)
+    valid, error = check_string_fields(data, required)
+    if not valid:
+        return make_error_response(error)
+
+    return jsonify({"message": "House flags query success.",
+                    "data": rule_engine.house_flags(data["house_uid"])}), 200
 
 ##################################
 # DEVICE SENSOR REPORT
 ##################################
 @app.route('/device/sensor_report', methods=['POST'])
+@idempotent(key_field="report_id")
 def device_sensor_report():
     """
     Endpoint to receive sensor data.
@@ -343,6 +2041,9 @@ def device_sensor_report():
       - belong_to_room
       - sensor_type
       - sensor_value
+    Optional fields:
+      - unit (converted to the sensor type's canonical unit, see SENSOR_TYPES)
+      - report_id (deduplicates retried reports)
     """
     data = request.get_json(force=True, silent=True)
     if not data:
@@ -352,13 +2053,190 @@ def device_sensor_report():
     valid, error = check_required_fields(data, required)
     if not valid:
         return make_error_response(error)
+    valid, error = check_string_fields(data, ["name", "belong_to_room"])
+    if not valid:
+        return make_error_response(error)
+
+    sensor_type = data["sensor_type"]
+    validator = SENSOR_VALIDATORS.get(sensor_type) if isinstance(sensor_type, str) else None
+    if validator is None:
+        return make_error_response(f"Unknown sensor_type '{sensor_type}'.")
+    try:
+        value = validator(data["sensor_value"], data.get("unit"))
+    except ValueError as e:
+        return make_error_response(str(e))
 
-    # You could also validate sensor_value or sensor_type here
+    shard = storage.shard_for_room(data["belong_to_room"], pin=True)
+    sid = shard.sensors.series_id(data["belong_to_room"], data["name"], sensor_type)
+    timestamp = int(time.time() * 1000)
+    shard.sensors.append(sid, timestamp, value)
+    rule_engine.evaluate(data["belong_to_room"], sensor_type, timestamp, value)
+    shard.anomalies.update(sid, timestamp, value)
     return jsonify({"message": "Sensor data received successfully."}), 200
 
+EXPORT_COLUMNS = ["timestamp", "belong_to_room", "name", "sensor_type", "sensor_value"]
+
+def iter_scope_batches(scopes, start=None, end=None):
+    """
+    Yield (series, ts, val, sid) batches over (shard, series ids) scopes,
+    where `series` resolves the batch's series ids to their keys.
+    """
+    for shard, series_ids in scopes:
+        for batch in shard.sensors.iter_batches(series_ids, start, end):
+            yield (shard.sensors.series, *batch)
+
+def export_csv(batches):
+    """
+    Generator yielding CSV text, one chunk per storage batch.
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buf.getvalue()
+    for series, ts_col, val_col, sid_col in batches:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows(
+            (ts, *series[sid], val) for ts, val, sid in zip(ts_col, val_col, sid_col)
+        )
+        yield buf.getvalue()
+
+def export_arrow(batches):
+    """
+    Generator yielding an Arrow IPC stream, one record batch per storage batch.
+    """
+    pa = optional_import("pyarrow")
+    schema = pa.schema([
+        ("timestamp", pa.timestamp("ms")),
+        ("belong_to_room", pa.string()),
+        ("name", pa.string()),
+        ("sensor_type", pa.string()),
+        ("sensor_value", pa.float64()),
+    ])
+    sink = io.BytesIO()
+
+    def drain():
+        chunk = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return chunk
+
+    with pa.ipc.new_stream(sink, schema) as writer:
+        yield drain()
+        for series, ts_col, val_col, sid_col in batches:
+            keys = [series[sid] for sid in sid_col]
+            writer.write_batch(pa.record_batch([
+                pa.array(ts_col, pa.timestamp("ms")),
+                pa.array([key[0] for key in keys], pa.string()),
+                pa.array([key[1] for key in keys], pa.string()),
+                pa.array([key[2] for key in keys], pa.string()),
+                pa.array(val_col, pa.float64()),
+            ], schema=schema))
+            yield drain()
+    yield drain()
+
+def merge_aggregates(results):
+    """
+    Combine SensorStore.aggregate() results into one.
+    """
+    count = sum(result["count"] for result in results)
+    counted = [result for result in results if result["count"]]
+    return {
+        "count": count,
+        "min": min((result["min"] for result in counted), default=None),
+        "max": max((result["max"] for result in counted), default=None),
+        "mean": sum(result["mean"] * result["count"] for result in counted) / count if count else None,
+    }
+
+def parse_sensor_scope(data):
+    """
+    Resolve the scope and time range shared by sensor export and stats.
+    Returns (scopes, start, end), where scopes are (shard, series ids) pairs.
+    Raises ValueError if invalid.
+    """
+    valid, error = check_string_fields(data, ["house_uid", "belong_to_room", "name"])
+    if not valid:
+        raise ValueError(error)
+
+    if "house_uid" in data:
+        rooms = storage.rooms_of(data["house_uid"])
+        name = None
+    elif "belong_to_room" in data:
+        rooms = [data["belong_to_room"]]
+        name = data.get("name")
+    else:
+        raise ValueError("'house_uid' or 'belong_to_room' is required.")
+
+    for field in ("start", "end"):
+        value = data.get(field)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+            raise ValueError(f"'{field}' must be an integer.")
+
+    return storage.sensor_scopes(rooms, name), data.get("start"), data.get("end")
+
+@app.route('/device/sensor_export', methods=['POST'])
+def device_sensor_export():
+    """
+    Stream stored sensor readings as CSV or Arrow IPC.
+    Exactly one scope is required:
+      - house_uid
+      - belong_to_room (optionally with name, for a single device)
+    Optional fields:
+      - start, end (timestamps in ms, end exclusive)
+      - format ("csv" by default, or "arrow")
+    """
+    data = request.get_json(force=True, silent=True)
+    if not data:
+        return make_error_response("Invalid or missing JSON.")
+
+    try:
+        scopes, start, end = parse_sensor_scope(data)
+    except ValueError as e:
+        return make_error_response(str(e))
+
+    fmt = data.get("format", "csv")
+    if fmt not in ("csv", "arrow"):
+        return make_error_response("'format' must be 'csv' or 'arrow'.")
+    if fmt == "arrow" and optional_import("pyarrow") is None:
+        return make_error_response("Arrow export requires pyarrow.")
+
+    batches = iter_scope_batches(scopes, start, end)
+    if fmt == "arrow":
+        return Response(export_arrow(batches), mimetype="application/vnd.apache.arrow.stream")
+    return Response(export_csv(batches), mimetype="text/csv")
+
+@app.route('/device/sensor_stats', methods=['POST'])
+def device_sensor_stats():
+    """
+    Summarize stored sensor readings (count/min/max/mean).
+    Takes the same scope and time range fields as /device/sensor_export.
+    """
+    data = request.get_json(force=True, silent=True)
+    if not data:
+        return make_error_response("Invalid or missing JSON.")
+
+    try:
+        scopes, start, end = parse_sensor_scope(data)
+    except ValueError as e:
+        return make_error_response(str(e))
+
+    result = merge_aggregates([shard.sensors.aggregate(series_ids, start, end)
+                               for shard, series_ids in scopes])
+    return jsonify({"message": "Sensor stats success.", "data": result}), 200
+
 ##################################
 # USERS
 ##################################
+def validate_users_add(data):
+    # Optional example: check for valid email format, etc.
+    require_fields(data, ["user_id", "name", "email"])
+
+def validate_users_remove(data):
+    require_fields(data, ["user_id"])
+
+def validate_users_update(data):
+    require_fields(data, ["user_id"])
+
 @app.route('/users/add', methods=['POST'])
 def users_add():
     """
@@ -371,13 +2249,7 @@ def users_add():
     if not data:
         return make_error_response("Invalid or missing JSON.")
 
-    required = ["user_id", "name", "email"]
-    valid, error = check_required_fields(data, required)
-    if not valid:
-        return make_error_response(error)
-
-    # Optional example: check for valid email format, etc.
-    return jsonify({"message": "User added successfully."}), 201
+    return run_operation("users/add", data)
 
 @app.route('/users/remove', methods=['POST'])
 def users_remove():
@@ -389,12 +2261,7 @@ def users_remove():
     if not data:
         return make_error_response("Invalid or missing JSON.")
 
-    required = ["user_id"]
-    valid, error = check_required_fields(data, required)
-    if not valid:
-        return make_error_response(error)
-
-    return jsonify({"message": "User removed successfully."}), 200
+    return run_operation("users/remove", data)
 
 @app.route('/users/update', methods=['POST'])
 def users_update():
@@ -409,10 +2276,7 @@ def users_update():
     if not data:
         return make_error_response("Invalid or missing JSON.")
 
-    if "user_id" not in data:
-        return make_error_response("'user_id' is required.")
-
-    return jsonify({"message": "User updated successfully."}), 200
+    return run_operation("users/update", data)
 
 @app.route('/users/query', methods=['POST'])
 def users_query():
@@ -420,11 +2284,14 @@ def users_query():
     Can pass user_id, name, etc. in the JSON if needed.
     """
     data = request.get_json(force=True, silent=True) or {}
-    return jsonify({"message": "Users query success.", "data": []}), 200
+    return jsonify({"message": "Users query success.", "data": storage.query("users", data)}), 200
 
 ##################################
 # HOUSE-USER RELATIONSHIP
 ##################################
+def validate_house_user(data):
+    require_fields(data, ["house_uid", "user_id"])
+
 @app.route('/house_user/add', methods=['POST'])
 def house_user_add():
     """
@@ -436,12 +2303,7 @@ def house_user_add():
     if not data:
         return make_error_response("Invalid or missing JSON.")
 
-    required = ["house_uid", "user_id"]
-    valid, error = check_required_fields(data, required)
-    if not valid:
-        return make_error_response(error)
-
-    return jsonify({"message": "House-User relation added successfully."}), 201
+    return run_operation("house_user/add", data)
 
 @app.route('/house_user/remove', methods=['POST'])
 def house_user_remove():
@@ -454,12 +2316,7 @@ def house_user_remove():
     if not data:
         return make_error_response("Invalid or missing JSON.")
 
-    required = ["house_uid", "user_id"]
-    valid, error = check_required_fields(data, required)
-    if not valid:
-        return make_error_response(error)
-
-    return jsonify({"message": "House-User relation removed successfully."}), 200
+    return run_operation("house_user/remove", data)
 
 @app.route('/house_user/query', methods=['POST'])
 def house_user_query():
@@ -467,7 +2324,81 @@ def house_user_query():
     Can pass house_uid, user_id in the JSON if needed.
     """
     data = request.get_json(force=True, silent=True) or {}
-    return jsonify({"message": "House-User relation query success.", "data": []}), 200
+    return jsonify({"message": "House-User relation query success.",
+                    "data": storage.query("house_users", data)}), 200
+
+##################################
+# BATCH
+##################################
+# op -> (validator, table, action, success message, status code)
+OPERATIONS = {
+    "house/add": (validate_house_add, "houses", "add", "House added successfully.", 201),
+    "house/remove": (validate_house_remove, "houses", "remove", "House removed successfully.", 200),
+    "house/update": (validate_house_update, "houses", "update", "House updated successfully.", 200),
+    "room/add": (validate_room_add, "rooms", "add", "Room added successfully.", 201),
+    "room/remove": (validate_room_remove, "rooms", "remove", "Room removed successfully.", 200),
+    "room/update": (validate_room_update, "rooms", "update", "Room updated successfully.", 200),
+    "device/add": (validate_device_add, "devices", "add", "Device added successfully.", 201),
+    "device/remove": (validate_device_remove, "devices", "remove", "Device removed successfully.", 200),
+    "device/update": (validate_device_update, "devices", "update", "Device updated successfully.", 200),
+    "users/add": (validate_users_add, "users", "add", "User added successfully.", 201),
+    "users/remove": (validate_users_remove, "users", "remove", "User removed successfully.", 200),
+    "users/update": (validate_users_update, "users", "update", "User updated successfully.", 200),
+    "house_user/add": (validate_house_user, "house_users", "add",
+                       "House-User relation added successfully.", 201),
+    "house_user/remove": (validate_house_user, "house_users", "remove",
+                          "House-User relation removed successfully.", 200),
+}
+
+@app.route('/batch', methods=['POST'])
+@idempotent()
+def batch():
+    """
+    Required JSON fields:
+      - operations: list of {"op": ..., "data": {...}}, where op is one of
+        OPERATIONS (e.g. "house/add") and data is that route's JSON payload
+    Every operation is validated first; then all of them are applied in a
+    single storage transaction, so either all take effect or none do.
+    """
+    data = request.get_json(force=True, silent=True)
+    if not data:
+        return make_error_response("Invalid or missing JSON.")
+
+    operations = data.get("operations") if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return make_error_response("'operations' must be a non-empty list.")
+
+    errors = []
+    changes = []
+    for index, operation in enumerate(operations):
+        op = operation.get("op") if isinstance(operation, dict) else None
+        payload = operation.get("data") if isinstance(operation, dict) else None
+        if not isinstance(op, str) or op not in OPERATIONS:
+            errors.append({"index": index, "op": op, "error": f"Unknown op '{op}'."})
+            continue
+        try:
+            validate_operation(op, payload)
+        except ValueError as e:
+            errors.append({"index": index, "op": op, "error": str(e)})
+            continue
+        _, table, action, _, _ = OPERATIONS[op]
+        changes.append((table, action, payload))
+
+    if errors:
+        return jsonify({"error": "Batch rejected; no operations were applied.", "errors": errors}), 400
+
+    try:
+        storage.transaction(changes)
+    except ConflictError as e:
+        op = operations[e.index]["op"]
+        return jsonify({"error": "Batch rejected; no operations were applied.",
+                        "errors": [{"index": e.index, "op": op, "error": str(e)}]}), 409
+
+    results = []
+    for operation in operations:
+        _, _, _, message, status = OPERATIONS[operation["op"]]
+        results.append({"op": operation["op"], "message": message, "status": status})
+    return jsonify({"message": "Batch applied successfully.", "results": results}), 200
 
 ##################################
 # MAIN
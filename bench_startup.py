@@ -0,0 +1,117 @@
+"""
+Startup benchmark: import-to-first-request latency of app.py.
+
+Every run starts fresh interpreters that import app and serve one request
+through the Flask test client -- a /house/query in one, a
+/device/sensor_report in the other -- then wait for the background warm-up
+to load every shard. Storage can be pre-populated with a synthetic fleet so
+the cost of loading it on a cold start shows up.
+
+Usage:
+    python bench_startup.py --runs 10 --houses 20000
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from loadtest import Fleet
+
+CHILD = r"""
+import json
+import sys
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.app.test_client().post(sys.argv[1], json=json.loads(sys.argv[2]))
+assert response.status_code == 200, response.status_code
+first_request = time.perf_counter()
+while not app.storage.progress()["warm"]:
+    time.sleep(0.001)
+warm = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "first_request": first_request - start,
+    "warm": warm - start,
+}))
+"""
+
+# metric -> (path, payload) of the first request of a cold start
+FIRST_REQUESTS = {
+    "first_query": ("/house/query", {"uid": "lt-house-0"}),
+    "first_report": ("/device/sensor_report", {
+        "name": "device-0",
+        "belong_to_room": Fleet(1).room_name(0, 0),
+        "sensor_type": "temperature",
+        "sensor_value": 21.5,
+    }),
+}
+
+POPULATE = r"""
+import sys
+from app import OPERATIONS, storage
+from loadtest import Fleet
+houses, houses_per_commit = int(sys.argv[1]), int(sys.argv[2])
+fleet = Fleet(houses)
+for first in range(0, houses, houses_per_commit):
+    changes = []
+    for house in range(first, min(first + houses_per_commit, houses)):
+        for operation in fleet.provision_operations(house):
+            _, table, action, _, _ = OPERATIONS[operation["op"]]
+            changes.append((table, action, operation["data"]))
+    storage.transaction(changes)
+"""
+
+def populate(env, houses, houses_per_commit=100):
+    """
+    Write a synthetic fleet into the storage configured by env. Runs in a
+    fresh interpreter, so app is imported with the benchmark's storage.
+    """
+    subprocess.run([sys.executable, "-c", POPULATE, str(houses), str(houses_per_commit)],
+                   env=env, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+def measure(env, path, payload):
+    output = subprocess.run([sys.executable, "-c", CHILD, path, json.dumps(payload)],
+                            env=env, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def cold_start(env):
+    """
+    Return the metrics of one run: a cold start per entry of FIRST_REQUESTS.
+    """
+    result = {}
+    for metric, (path, payload) in FIRST_REQUESTS.items():
+        timings = measure(env, path, payload)
+        result[metric] = timings["first_request"]
+        result.setdefault("import", timings["import"])
+        result.setdefault("warm", timings["warm"])
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--houses", type=int, default=0, help="houses to pre-populate")
+    parser.add_argument("--shards", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        journal = os.path.join(data_dir, "journal")
+        env = dict(os.environ, SENSOR_DATA_DIR=data_dir, ENTITY_JOURNAL=journal,
+                   STORAGE_SHARDS=str(args.shards))
+        if args.houses:
+            populate(env, args.houses)
+        runs = [cold_start(env) for _ in range(args.runs)]
+
+    print(f"{args.runs} cold starts, {args.houses} houses in {args.shards} shards")
+    for metric in ("import", *FIRST_REQUESTS, "warm"):
+        values = [run[metric] * 1000 for run in runs]
+        print(f"{metric:>14}: median={statistics.median(values):.1f}ms max={max(values):.1f}ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+"""
+Load-test harness for the Smart Home API.
+
+Provisions a synthetic fleet of houses, rooms and devices (one /batch call
+per house, using the /house/add, /room/add and /device/add payload shapes),
+then replays an open-loop Poisson stream of /device/sensor_report calls.
+
+Latency is measured from each request's *intended* send time, so requests
+delayed by a saturated server or an exhausted connection pool still count
+their waiting time (coordinated-omission correction).
+
+Usage:
+    python loadtest.py --houses 1000 --rate 500 --duration 30
+    python loadtest.py --url http://127.0.0.1:5000 ...   # existing server
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from urllib.parse import urlsplit
+
+##################################
+# FLEET
+##################################
+# sensor_type -> (low, high) of generated readings
+REPORT_RANGES = {
+    "temperature": (18.0, 26.0),
+    "humidity": (30.0, 60.0),
+    "co2": (400.0, 1200.0),
+    "light": (0.0, 800.0),
+}
+REPORT_TYPES = list(REPORT_RANGES)
+
+class Fleet:
+    """
+    A synthetic fleet described only by its sizes: every house, room and
+    device is derived from its index, so fleets of millions of devices
+    never have to be held in memory.
+    """
+    def __init__(self, houses, rooms_per_house=4, devices_per_room=3):
+        self.houses = houses
+        self.rooms_per_house = rooms_per_house
+        self.devices_per_room = devices_per_room
+
+    @property
+    def devices(self):
+        return self.houses * self.rooms_per_house * self.devices_per_room
+
+    def house_uid(self, house):
+        return f"lt-house-{house}"
+
+    def room_name(self, house, room):
+        # Devices refer to rooms by name alone, so room names are fleet-unique
+        return f"lt-house-{house}-room-{room}"
+
+    def provision_operations(self, house):
+        """
+        Return the /batch operations creating one house with its rooms and devices.
+        """
+        uid = self.house_uid(house)
+        operations = [{"op": "house/add", "data": {
+            "name": f"Load Test House {house}",
+            "lat": (house % 180) - 90.0,
+            "lon": (house % 360) - 180.0,
+            "addr": f"{house} Load Test Rd",
+            "uid": uid,
+            "floors": 1 + house % 3,
+            "size": 80 + house % 200,
+        }}]
+        for room in range(self.rooms_per_house):
+            name = self.room_name(house, room)
+            operations.append({"op": "room/add", "data": {
+                "name": name,
+                "belong_to_house": uid,
+                "size": 10 + room,
+                "floor": 1,
+            }})
+            for device in range(self.devices_per_room):
+                operations.append({"op": "device/add", "data": {
+                    "name": f"device-{device}",
+                    "belong_to_room": name,
+                    "type": REPORT_TYPES[device % len(REPORT_TYPES)] + "_sensor",
+                }})
+        return operations
+
+    def sensor_report(self, rng, report_id):
+        """
+        Return a /device/sensor_report payload for a uniformly random device,
+        deduplicated by `report_id`.
+        """
+        index = rng.randrange(self.devices)
+        device = index % self.devices_per_room
+        room = index // self.devices_per_room % self.rooms_per_house
+        house = index // (self.devices_per_room * self.rooms_per_house)
+        sensor_type = REPORT_TYPES[device % len(REPORT_TYPES)]
+        low, high = REPORT_RANGES[sensor_type]
+        return {
+            "name": f"device-{device}",
+            "belong_to_room": self.room_name(house, room),
+            "sensor_type": sensor_type,
+            "sensor_value": round(rng.uniform(low, high), 2),
+            "report_id": report_id,
+        }
+
+##################################
+# LATENCY HISTOGRAM
+##################################
+class LatencyHistogram:
+    """
+    Log-bucketed latency histogram: every bucket spans 1% of its value,
+    so percentiles are accurate to 1% at constant memory, whatever the
+    number of samples.
+    """
+    GROWTH = math.log(1.01)
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.max = 0.0
+
+    def record(self, seconds):
+        micros = max(seconds * 1e6, 1.0)
+        bucket = int(math.log(micros) / self.GROWTH)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def percentile(self, pct):
+        """
+        Return the latency in seconds at percentile `pct` (0-100).
+        """
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * pct / 100)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                # Upper edge of the bucket, capped at the true maximum
+                return min(math.exp((bucket + 1) * self.GROWTH) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            **{f"p{pct:g}": self.percentile(pct) for pct in (50, 90, 99, 99.9)},
+            "max": self.max,
+        }
+
+##################################
+# HTTP CLIENT
+##################################
+class ConnectionPool:
+    """
+    Keep-alive HTTP/1.1 connections to one host, opened lazily up to `size`.
+    Requests beyond that wait for a free connection.
+    """
+    def __init__(self, host, port, size):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.opened = 0
+        self.idle = asyncio.Queue()
+
+    async def acquire(self):
+        if self.idle.empty() and self.opened < self.size:
+            self.opened += 1
+            try:
+                return await asyncio.open_connection(self.host, self.port)
+            except OSError:
+                self.opened -= 1
+                raise
+        return await self.idle.get()
+
+    def release(self, connection, reusable=True):
+        if reusable:
+            self.idle.put_nowait(connection)
+        else:
+            connection[1].close()
+            self.opened -= 1
+
+    async def post(self, path, payload):
+        """
+        POST JSON and return (status, body bytes, send time), where the
+        send time is the loop time at which a connection became available.
+        """
+        body = json.dumps(payload).encode()
+        head = (f"POST {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n")
+        reader, writer = connection = await self.acquire()
+        sent = asyncio.get_running_loop().time()
+        try:
+            writer.write(head.encode() + body)
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            data = await reader.readexactly(int(headers.get("content-length", 0)))
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            self.release(connection, reusable=False)
+            raise
+        self.release(connection, reusable=headers.get("connection", "").lower() != "close")
+        return status, data, sent
+
+    async def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait()[1].close()
+
+##################################
+# RUNNER
+##################################
+async def provision(pool, fleet, concurrency):
+    """
+    Create the fleet, one /batch transaction per house.
+    Returns the number of houses that failed.
+    """
+    failures = 0
+    houses = iter(range(fleet.houses))
+
+    async def worker():
+        nonlocal failures
+        for house in houses:
+            try:
+                status, _, _ = await pool.post("/batch", {"operations": fleet.provision_operations(house)})
+            except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                status = None
+            if status != 200:
+                failures += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return failures
+
+async def replay_reports(pool, fleet, rate, duration, seed=0):
+    """
+    Send a Poisson stream of sensor reports at `rate` per second for
+    `duration` seconds, open-loop: send times are fixed up front and never
+    wait for earlier responses. Returns (corrected, service, errors) where
+    `corrected` is measured from the intended send time and `service`
+    from the moment a connection was actually available.
+    Report ids carry a per-run nonce, so a repeated run against the same
+    server is never answered from its idempotency cache.
+    """
+    rng = random.Random(seed)
+    corrected = LatencyHistogram()
+    service = LatencyHistogram()
+    errors = 0
+    tasks = []
+    loop = asyncio.get_running_loop()
+
+    async def send(intended, payload):
+        nonlocal errors
+        try:
+            status, _, sent = await pool.post("/device/sensor_report", payload)
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            status = None
+        finished = loop.time()
+        if status != 200:
+            errors += 1
+            return
+        corrected.record(finished - intended)
+        service.record(finished - sent)
+
+    start = loop.time()
+    intended = start
+    run_id = uuid.uuid4().hex
+    report_id = 0
+    while True:
+        intended += rng.expovariate(rate)
+        if intended - start >= duration:
+            break
+        delay = intended - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        report_id += 1
+        payload = fleet.sensor_report(rng, f"lt-{run_id}-{report_id}")
+        tasks.append(asyncio.create_task(send(intended, payload)))
+    await asyncio.gather(*tasks)
+    return corrected, service, errors
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def launch_server(port, data_dir):
+    """
+    Start app.py in a subprocess on `port` and wait until it accepts connections.
+    """
+    code = ("import app; app.app.run(host='127.0.0.1', port=%d, threaded=True)" % port)
+    env = dict(os.environ, SENSOR_DATA_DIR=data_dir)
+    server = subprocess.Popen([sys.executable, "-c", code], env=env,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("Server exited during startup.")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.terminate()
+    raise RuntimeError("Server did not start within 30 seconds.")
+
+def format_summary(name, histogram):
+    stats = histogram.summary()
+    parts = [f"{key}={value * 1000:.2f}ms" for key, value in stats.items() if key != "count"]
+    return f"{name:>10}: n={stats['count']} " + " ".join(parts)
+
+async def run(args):
+    fleet = Fleet(args.houses, args.rooms_per_house, args.devices_per_room)
+    url = urlsplit(args.url)
+    pool = ConnectionPool(url.hostname, url.port or 80, args.connections)
+    try:
+        if not args.skip_provision:
+            began = time.monotonic()
+            failures = await provision(pool, fleet, args.connections)
+            print(f"provisioned {fleet.houses} houses / {fleet.devices} devices "
+                  f"in {time.monotonic() - began:.1f}s ({failures} failed)")
+        corrected, service, errors = await replay_reports(
+            pool, fleet, args.rate, args.duration, args.seed)
+    finally:
+        await pool.close()
+    print(f"sensor reports at {args.rate}/s for {args.duration}s ({errors} errors)")
+    print(format_summary("corrected", corrected))
+    print(format_summary("service", service))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--houses", type=int, default=100)
+    parser.add_argument("--rooms-per-house", type=int, default=4)
+    parser.add_argument("--devices-per-room", type=int, default=3)
+    parser.add_argument("--rate", type=float, default=200.0, help="sensor reports per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of report traffic")
+    parser.add_argument("--connections", type=int, default=32, help="connection pool size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", help="target an already running server instead of launching one")
+    parser.add_argument("--skip-provision", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.url:
+        asyncio.run(run(args))
+        return
+    with tempfile.TemporaryDirectory() as data_dir:
+        port = free_port()
+        server = launch_server(port, data_dir)
+        try:
+            args.url = f"http://127.0.0.1:{port}"
+            asyncio.run(run(args))
+        finally:
+            server.terminate()
+            server.wait()
+
+if __name__ == '__main__':
+    main()
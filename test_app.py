@@ -1,14 +1,37 @@
+import asyncio
+import atexit
+import os
+import random
+import shutil
+import tempfile
+import threading
+
 import pytest
-from app import app
+
+# app opens its storage at import time: keep it away from a developer's ./sensor_data
+os.environ["SENSOR_DATA_DIR"] = tempfile.mkdtemp(prefix="smart-home-test-")
+atexit.register(shutil.rmtree, os.environ["SENSOR_DATA_DIR"], ignore_errors=True)
+os.environ.pop("ENTITY_JOURNAL", None)
+
+import app as app_module
+from loadtest import Fleet, LatencyHistogram, replay_reports
+from app import (app, idempotency_cache, rule_engine, AnomalyDetector, ConflictError,
+                 EntityStore, IdempotencyCache, RuleEngine, SensorStore, ShardedStorage,
+                 SENSOR_VALIDATORS)
 
 @pytest.fixture
-def client():
+def client(tmp_path, monkeypatch):
     """
     Pytest fixture to create a Flask test client.
     This allows sending requests to the Flask app
     without running a real server.
+    Every test gets fresh storage under its own tmp_path.
     """
     app.config['TESTING'] = True
+    monkeypatch.setattr(app_module, "storage",
+                        ShardedStorage(app_module.STORAGE_SHARDS, str(tmp_path / "sensor_data")))
+    idempotency_cache.clear()
+    rule_engine.clear()
     with app.test_client() as client:
         yield client
 
@@ -111,6 +134,39 @@ def test_house_query_success(client):
     assert data["message"] == "House query success."
     assert isinstance(data["data"], list)
 
+def test_house_add_duplicate_uid(client):
+    payload = {
+        "name": "My House",
+        "lat": 45.0,
+        "lon": 100.0,
+        "addr": "123 Test St",
+        "uid": "unique-456",
+        "floors": 2,
+        "size": 100
+    }
+    assert client.post('/house/add', json=payload).status_code == 201
+    response = client.post('/house/add', json=payload)
+    assert response.status_code == 409
+    data = response.get_json()
+    assert "already exists" in data["error"]
+
+def test_house_query_returns_stored_houses(client):
+    payload = {
+        "name": "Query House",
+        "lat": 45.0,
+        "lon": 100.0,
+        "addr": "123 Test St",
+        "uid": "query-house",
+        "floors": 2,
+        "size": 100
+    }
+    client.post('/house/add', json=payload)
+    client.post('/house/update', json={"uid": "query-house", "floors": 4})
+    response = client.post('/house/query', json={"uid": "query-house"})
+    data = response.get_json()
+    assert len(data["data"]) == 1
+    assert data["data"][0]["floors"] == 4
+
 ##################################
 # ROOM TESTS
 ##################################
@@ -288,6 +344,857 @@ def test_device_sensor_report_missing_field(client):
     data = response.get_json()
     assert "'sensor_type' is required." in data["error"]
 
+def test_device_sensor_report_non_numeric_value(client):
+    payload = {
+        "name": "Thermostat",
+        "belong_to_room": "room-123",
+        "sensor_type": "temperature",
+        "sensor_value": "hot"
+    }
+    response = client.post('/device/sensor_report', json=payload)
+    assert response.status_code == 400
+    data = response.get_json()
+    assert "'sensor_value' must be a number." in data["error"]
+
+def test_device_sensor_report_huge_integer(client):
+    payload = {
+        "name": "Thermostat",
+        "belong_to_room": "room-123",
+        "sensor_type": "temperature",
+        "sensor_value": 10 ** 400
+    }
+    response = client.post('/device/sensor_report', json=payload)
+    assert response.status_code == 400
+    assert "'sensor_value' must be a number." in response.get_json()["error"]
+
+def test_device_sensor_report_unknown_type(client):
+    payload = {
+        "name": "Thermostat",
+        "belong_to_room": "room-123",
+        "sensor_type": "vibes",
+        "sensor_value": 1
+    }
+    response = client.post('/device/sensor_report', json=payload)
+    assert response.status_code == 400
+    data = response.get_json()
+    assert "Unknown sensor_type 'vibes'." in data["error"]
+
+def test_device_sensor_report_out_of_range(client):
+    payload = {
+        "name": "Hygrometer",
+        "belong_to_room": "room-123",
+        "sensor_type": "humidity",
+        "sensor_value": 140
+    }
+    response = client.post('/device/sensor_report', json=payload)
+    assert response.status_code == 400
+    data = response.get_json()
+    assert "out of range for humidity" in data["error"]
+
+def test_device_sensor_report_non_string_room(client):
+    payload = {
+        "name": "Thermostat",
+        "belong_to_room": ["room-123"],
+        "sensor_type": "temperature",
+        "sensor_value": 22.5
+    }
+    response = client.post('/device/sensor_report', json=payload)
+    assert response.status_code == 400
+    data = response.get_json()
+    assert "'belong_to_room' must be a string." in data["error"]
+
+def test_sensor_validator_converts_units():
+    temperature = SENSOR_VALIDATORS["temperature"]
+    assert temperature(212, "F") == pytest.approx(100.0)
+    assert temperature("300.15", "K") == pytest.approx(27.0)
+    assert SENSOR_VALIDATORS["motion"](True) == 1.0
+    with pytest.raises(ValueError, match="Unknown unit"):
+        temperature(20, "parsec")
+    with pytest.raises(ValueError, match="out of range"):
+        temperature("nan")
+    with pytest.raises(ValueError, match="must be a number"):
+        temperature(True)
+    with pytest.raises(ValueError, match="must be a number"):
+        temperature(10 ** 400)
+
+##################################
+# SENSOR STORAGE TESTS
+##################################
+def test_sensor_store_seals_full_segment(tmp_path):
+    store = SensorStore(str(tmp_path), segment_rows=3)
+    sid = store.series_id("room-1", "Thermostat", "temperature")
+    for i, value in enumerate([20.0, 21.0, 22.0, 23.0]):
+        store.append(sid, 1000 + i, value)
+
+    assert len(store.segments) == 1
+    assert len(store.segments[0]) == 3
+    assert list(store.segments[0].columns["val"]) == [20.0, 21.0, 22.0]
+    # The fourth row is still in the active segment
+    assert list(store.active["val"]) == [23.0]
+    store.close()
+
+def test_sensor_store_aggregate_filters(tmp_path):
+    store = SensorStore(str(tmp_path), segment_rows=2)
+    temp = store.series_id("room-1", "Thermostat", "temperature")
+    hum = store.series_id("room-1", "Hygrometer", "humidity")
+    store.append(temp, 1000, 20.0)
+    store.append(hum, 1001, 55.0)
+    store.append(temp, 1002, 24.0)
+
+    result = store.aggregate([temp])
+    assert result == {"count": 2, "min": 20.0, "max": 24.0, "mean": 22.0}
+    assert store.aggregate([temp], start=1001)["count"] == 1
+    assert store.aggregate([], start=0)["mean"] is None
+    store.close()
+
+def test_sensor_store_numpy_matches_fallback(tmp_path, monkeypatch):
+    pytest.importorskip("numpy")
+    store = SensorStore(str(tmp_path), segment_rows=4)
+    sids = [store.series_id("room-1", f"Device {i}", "temperature") for i in range(3)]
+    for i in range(10):
+        store.append(sids[i % 3], 1000 + i, float(i))
+
+    fast = (store.aggregate(sids[:2], start=1002),
+            [list(map(list, batch)) for batch in store.iter_batches(sids[:2], end=1008, batch_rows=3)])
+    monkeypatch.setattr(app_module, "optional_import", lambda name: None)
+    slow = (store.aggregate(sids[:2], start=1002),
+            [list(map(list, batch)) for batch in store.iter_batches(sids[:2], end=1008, batch_rows=3)])
+
+    assert fast[0] == slow[0] == {"count": 5, "min": 3.0, "max": 9.0, "mean": 5.8}
+    flatten = lambda batches: [row for batch in batches for row in zip(*batch)]
+    assert flatten(fast[1]) == flatten(slow[1])
+    assert [row[1] for row in flatten(fast[1])] == [0.0, 1.0, 3.0, 4.0, 6.0, 7.0]
+    store.close()
+
+def test_sensor_store_reopens_sealed_segments(tmp_path):
+    store = SensorStore(str(tmp_path))
+    sid = store.series_id("room-1", "Thermostat", "temperature")
+    store.append(sid, 1000, 21.5)
+    store.seal()
+    store.close()
+
+    reopened = SensorStore(str(tmp_path))
+    assert reopened.series_id("room-1", "Thermostat", "temperature") == sid
+    assert reopened.aggregate([sid])["max"] == 21.5
+    reopened.close()
+
+def test_sensor_store_replays_active_segment(tmp_path):
+    store = SensorStore(str(tmp_path), segment_rows=2)
+    sid = store.series_id("room-1", "Thermostat", "temperature")
+    for i, value in enumerate([20.0, 21.0, 22.0]):
+        store.append(sid, 1000 + i, value)
+    store.close()
+    # Simulate a crash in the middle of writing a record
+    with open(tmp_path / "active-000001.wal", "ab") as f:
+        f.write(b"\x00" * 7)
+
+    reopened = SensorStore(str(tmp_path), segment_rows=2)
+    assert reopened.series_id("room-1", "Thermostat", "temperature") == sid
+    assert list(reopened.active["val"]) == [22.0]
+    assert reopened.aggregate([sid]) == {"count": 3, "min": 20.0, "max": 22.0, "mean": 21.0}
+    reopened.append(sid, 1003, 23.0)
+    reopened.close()
+
+    # Sealing removes the log, so nothing is replayed twice
+    again = SensorStore(str(tmp_path), segment_rows=2)
+    assert len(again.segments) == 2
+    assert not list(tmp_path.glob("*.wal"))
+    assert again.aggregate([sid])["count"] == 4
+    again.close()
+
+def test_sensor_store_recovers_from_interrupted_seal(tmp_path):
+    store = SensorStore(str(tmp_path), segment_rows=2)
+    sid = store.series_id("room-1", "Thermostat", "temperature")
+    store.append(sid, 1000, 20.0)
+    store.close()
+    # A crash while sealing leaves columns under temporary names only
+    for column in ("ts", "val", "sid"):
+        (tmp_path / f"segment-000000.{column}.tmp").write_bytes(b"")
+
+    reopened = SensorStore(str(tmp_path), segment_rows=2)
+    assert reopened.segments == []
+    assert not list(tmp_path.glob("*.tmp"))
+    assert reopened.aggregate([sid])["count"] == 1
+    reopened.close()
+
+def test_sensor_segment_rejects_mismatched_columns(tmp_path):
+    store = SensorStore(str(tmp_path))
+    sid = store.series_id("room-1", "Thermostat", "temperature")
+    store.append(sid, 1000, 20.0)
+    store.append(sid, 1001, 21.0)
+    store.seal()
+    store.close()
+    with open(tmp_path / "segment-000000.sid", "r+b") as f:
+        f.truncate(4)
+    with pytest.raises(RuntimeError, match="is damaged"):
+        SensorStore(str(tmp_path))
+
+def test_sharded_storage_clear_drops_sensor_data(tmp_path):
+    storage = ShardedStorage(2, str(tmp_path))
+    store = storage.shard_for_room("room-1").sensors
+    store.append(store.series_id("room-1", "Thermostat", "temperature"), 1000, 20.0)
+    storage.clear()
+    assert storage.shard_for_room("room-1").sensors.series_ids_for(["room-1"]) == []
+
+    reopened = ShardedStorage(2, str(tmp_path))
+    assert reopened.shard_for_room("room-1").sensors.aggregate()["count"] == 0
+
+##################################
+# SENSOR EXPORT TESTS
+##################################
+def report(client, room, name, sensor_type, value):
+    payload = {
+        "name": name,
+        "belong_to_room": room,
+        "sensor_type": sensor_type,
+        "sensor_value": value
+    }
+    assert client.post('/device/sensor_report', json=payload).status_code == 200
+
+def test_device_sensor_export_csv(client):
+    report(client, "export-room-1", "Thermostat", "temperature", 21.0)
+    report(client, "export-room-1", "Hygrometer", "humidity", 40.0)
+    payload = {"belong_to_room": "export-room-1", "name": "Thermostat"}
+    response = client.post('/device/sensor_export', json=payload)
+    assert response.status_code == 200
+    assert response.mimetype == "text/csv"
+    lines = response.get_data(as_text=True).splitlines()
+    assert lines[0] == "timestamp,belong_to_room,name,sensor_type,sensor_value"
+    assert len(lines) == 2
+    assert lines[1].endswith(",export-room-1,Thermostat,temperature,21.0")
+
+def test_device_sensor_export_house(client):
+    room = {"name": "export-room-2", "belong_to_house": "export-house", "size": 10, "floor": 1}
+    assert client.post('/room/add', json=room).status_code == 201
+    report(client, "export-room-2", "Thermostat", "temperature", 19.5)
+    response = client.post('/device/sensor_export', json={"house_uid": "export-house"})
+    assert response.status_code == 200
+    assert len(response.get_data(as_text=True).splitlines()) == 2
+
+def test_device_sensor_export_arrow(client):
+    pa = pytest.importorskip("pyarrow")
+    report(client, "export-room-3", "Thermostat", "temperature", 25.0)
+    payload = {"belong_to_room": "export-room-3", "format": "arrow"}
+    response = client.post('/device/sensor_export', json=payload)
+    assert response.status_code == 200
+    table = pa.ipc.open_stream(response.get_data()).read_all()
+    assert table.column("sensor_value").to_pylist() == [25.0]
+
+def test_device_sensor_stats(client):
+    report(client, "stats-room", "Thermostat", "temperature", 20.0)
+    report(client, "stats-room", "Thermostat", "temperature", 23.0)
+    response = client.post('/device/sensor_stats', json={"belong_to_room": "stats-room"})
+    assert response.status_code == 200
+    assert response.get_json()["data"] == {"count": 2, "min": 20.0, "max": 23.0, "mean": 21.5}
+
+def test_device_sensor_export_missing_scope(client):
+    response = client.post('/device/sensor_export', json={"format": "csv"})
+    assert response.status_code == 400
+    data = response.get_json()
+    assert "'house_uid' or 'belong_to_room' is required." in data["error"]
+
+def test_device_sensor_export_non_string_scope(client):
+    response = client.post('/device/sensor_export', json={"house_uid": {"uid": "h"}})
+    assert response.status_code == 400
+    data = response.get_json()
+    assert "'house_uid' must be a string." in data["error"]
+
+##################################
+# IDEMPOTENCY TESTS
+##################################
+def test_sensor_report_retry_deduplicated(client):
+    payload = {
+        "name": "Thermostat",
+        "belong_to_room": "idem-room-1",
+        "sensor_type": "temperature",
+        "sensor_value": 20.0,
+        "report_id": "report-1"
+    }
+    first = client.post('/device/sensor_report', json=payload)
+    retry = client.post('/device/sensor_report', json=payload)
+    assert first.status_code == retry.status_code == 200
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.get_json() == first.get_json()
+
+    response = client.post('/device/sensor_export', json={"belong_to_room": "idem-room-1"})
+    assert len(response.get_data(as_text=True).splitlines()) == 2
+
+def test_house_add_idempotency_key_header(client):
+    payload = {
+        "name": "My House",
+        "lat": 45.0,
+        "lon": 100.0,
+        "addr": "123 Test St",
+        "uid": "idem-house-1",
+        "floors": 2,
+        "size": 100
+    }
+    headers = {"Idempotency-Key": "add-idem-house-1"}
+    first = client.post('/house/add', json=payload, headers=headers)
+    retry = client.post('/house/add', json=payload, headers=headers)
+    assert first.status_code == retry.status_code == 201
+    assert "Idempotent-Replayed" not in first.headers
+    assert retry.headers["Idempotent-Replayed"] == "true"
+
+def test_sensor_report_retry_with_different_body_rejected(client):
+    payload = {
+        "name": "Thermostat",
+        "belong_to_room": "idem-room-2",
+        "sensor_type": "temperature",
+        "sensor_value": 20.0,
+        "report_id": "report-2"
+    }
+    assert client.post('/device/sensor_report', json=payload).status_code == 200
+    payload["sensor_value"] = 30.0
+    response = client.post('/device/sensor_report', json=payload)
+    assert response.status_code == 422
+    assert "different request" in response.get_json()["error"]
+
+def test_idempotency_cache_tracks_in_flight_keys():
+    cache = IdempotencyCache()
+    assert cache.begin("k", "fp-1") == ("run", None)
+    state, event = cache.begin("k", "fp-1")
+    assert state == "wait" and not event.is_set()
+    assert cache.begin("k", "fp-2") == ("mismatch", None)
+
+    cache.finish("k", b"{}", 200)
+    assert event.is_set()
+    assert cache.begin("k", "fp-1") == ("replay", (b"{}", 200))
+    assert cache.begin("k", "fp-2") == ("mismatch", None)
+
+    # A request that is not cached (e.g. 5xx) frees the key for a retry
+    assert cache.begin("other", "fp-1") == ("run", None)
+    cache.finish("other")
+    assert cache.begin("other", "fp-1") == ("run", None)
+
+def cache_response(cache, key, body, status=200):
+    assert cache.begin(key, "fp") == ("run", None)
+    cache.finish(key, body, status)
+
+def cached_response(cache, key):
+    state, value = cache.begin(key, "fp")
+    if state == "run":
+        cache.finish(key)
+        return None
+    return value
+
+def test_idempotency_cache_evicts_oldest():
+    probe = IdempotencyCache()
+    cache_response(probe, "a", b"1234")
+    # Keys and fingerprints count towards the byte cap too
+    assert probe.size > len(b"1234") + len("a") + len("fp")
+
+    cache = IdempotencyCache(max_entries=2, max_bytes=2 * probe.size + 1)
+    for key in ("a", "b", "c"):
+        cache_response(cache, key, b"1234")
+    assert cached_response(cache, "a") is None
+    assert cached_response(cache, "c") == (b"1234", 200)
+    # Byte cap: one large entry pushes out everything older
+    cache_response(cache, "d", b"1234" * 20, 201)
+    assert cached_response(cache, "b") is None and cached_response(cache, "c") is None
+    assert cached_response(cache, "d") == (b"1234" * 20, 201)
+
+def test_idempotency_cache_expires_entries():
+    cache = IdempotencyCache(ttl=0)
+    cache_response(cache, "a", b"{}")
+    assert cached_response(cache, "a") is None
+    assert cache.size == 0
+
+##################################
+# BATCH TESTS
+##################################
+PROVISION_OPERATIONS = [
+    {"op": "house/add", "data": {
+        "name": "Batch House", "lat": 1.0, "lon": 2.0, "addr": "1 Batch Rd",
+        "uid": "batch-house", "floors": 1, "size": 80
+    }},
+    {"op": "room/add", "data": {
+        "name": "batch-kitchen", "belong_to_house": "batch-house", "size": 20, "floor": 1
+    }},
+    {"op": "device/add", "data": {
+        "name": "Oven", "belong_to_room": "batch-kitchen", "type": "oven"
+    }},
+    {"op": "house_user/add", "data": {"house_uid": "batch-house", "user_id": "user123"}},
+]
+
+def test_batch_provision_house(client):
+    response = client.post('/batch', json={"operations": PROVISION_OPERATIONS})
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["message"] == "Batch applied successfully."
+    assert [r["status"] for r in data["results"]] == [201, 201, 201, 201]
+
+    rooms = client.post('/room/query', json={"belong_to_house": "batch-house"}).get_json()
+    assert [room["name"] for room in rooms["data"]] == ["batch-kitchen"]
+
+def test_batch_validation_error_applies_nothing(client):
+    operations = PROVISION_OPERATIONS + [{"op": "room/add", "data": {"name": "No House"}}]
+    response = client.post('/batch', json={"operations": operations})
+    assert response.status_code == 400
+    data = response.get_json()
+    assert data["errors"][0]["index"] == 4
+    assert "'belong_to_house' is required." in data["errors"][0]["error"]
+    assert client.post('/house/query', json={}).get_json()["data"] == []
+
+def test_batch_conflict_rolls_back(client):
+    operations = PROVISION_OPERATIONS + [PROVISION_OPERATIONS[2]]
+    response = client.post('/batch', json={"operations": operations})
+    assert response.status_code == 409
+    assert response.get_json()["errors"][0]["index"] == 4
+    assert client.post('/house/query', json={}).get_json()["data"] == []
+    assert client.post('/device/query', json={}).get_json()["data"] == []
+
+def test_batch_unknown_op(client):
+    response = client.post('/batch', json={"operations": [{"op": "house/drop", "data": {"uid": "x"}}]})
+    assert response.status_code == 400
+    assert "Unknown op 'house/drop'." in response.get_json()["errors"][0]["error"]
+
+def entity_commit(store, changes):
+    undo = []
+    for table, action, data in changes:
+        store.apply(table, action, data, undo)
+    store.journal(changes)
+
+def test_entity_store_refuses_corrupt_journal(tmp_path):
+    journal = tmp_path / "journal.jsonl"
+    store = EntityStore(str(journal))
+    for i in range(1, 4):
+        entity_commit(store, [("users", "add", {"user_id": f"u{i}", "name": "-", "email": "-"})])
+    lines = journal.read_bytes().splitlines(keepends=True)
+    damaged = lines[0] + b"garbage\n" + b"".join(lines[2:])
+    journal.write_bytes(damaged)
+    # Committed transactions after the damage are kept on disk, not truncated
+    with pytest.raises(RuntimeError, match="is corrupt"):
+        EntityStore(str(journal))
+    assert journal.read_bytes() == damaged
+
+def test_batch_non_string_op(client):
+    response = client.post('/batch', json={"operations": [{"op": ["house/add"], "data": {"uid": "x"}}]})
+    assert response.status_code == 400
+    assert "Unknown op" in response.get_json()["errors"][0]["error"]
+
+def test_operations_reject_non_object_payloads(client):
+    response = client.post('/house/remove', json="uid")
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Invalid or missing JSON."
+
+@pytest.mark.parametrize("uid", [["R1"], 1, None])
+def test_operations_require_string_keys(client, uid):
+    response = client.post('/users/add', json={"user_id": uid, "name": "-", "email": "-"})
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "'user_id' must be a string."
+
+    operations = [{"op": "house_user/add", "data": {"house_uid": "h", "user_id": uid}}]
+    response = client.post('/batch', json={"operations": operations})
+    assert response.status_code == 400
+    assert response.get_json()["errors"][0]["error"] == "'user_id' must be a string."
+
+def test_entity_store_replays_journal(tmp_path):
+    journal = str(tmp_path / "journal.jsonl")
+    store = EntityStore(journal)
+    entity_commit(store, [
+        ("users", "add", {"user_id": "u1", "name": "Alice", "email": "a@example.com"}),
+        ("users", "update", {"user_id": "u1", "name": "Alicia"}),
+    ])
+    with open(journal, "a") as f:
+        f.write('[["users", "remove", {"user_')  # torn, uncommitted write
+
+    reopened = EntityStore(journal)
+    assert reopened.query("users", {"user_id": "u1"})[0]["name"] == "Alicia"
+
+    # The torn tail is truncated, so commits after it replay cleanly
+    entity_commit(reopened, [("users", "add", {"user_id": "u2", "name": "Bob", "email": "b@example.com"})])
+    again = EntityStore(journal)
+    assert again.query("users", {"user_id": "u1"})[0]["name"] == "Alicia"
+    assert again.query("users", {"user_id": "u2"})[0]["name"] == "Bob"
+
+##################################
+# RULE TESTS
+##################################
+HOT_ROOM_RULE = {
+    "rule_id": "hot-room",
+    "belong_to_house": "rule-house",
+    "belong_to_room": "rule-room",
+    "sensor_type": "temperature",
+    "op": ">",
+    "threshold": 30
+}
+
+def test_rule_flags_house_on_report(client):
+    assert client.post('/rule/add', json=HOT_ROOM_RULE).status_code == 201
+    report(client, "rule-room", "Thermostat", "temperature", 35.0)
+    response = client.post('/house/flags', json={"house_uid": "rule-house"})
+    assert response.status_code == 200
+    flags = response.get_json()["data"]
+    assert [flag["rule_id"] for flag in flags] == ["hot-room"]
+
+    report(client, "rule-room", "Thermostat", "temperature", 20.0)
+    response = client.post('/house/flags', json={"house_uid": "rule-house"})
+    assert response.get_json()["data"] == []
+
+def test_rule_add_invalid_op(client):
+    payload = dict(HOT_ROOM_RULE, op="~")
+    response = client.post('/rule/add', json=payload)
+    assert response.status_code == 400
+    data = response.get_json()
+    assert "'op' must be one of" in data["error"]
+
+@pytest.mark.parametrize("field, value, error", [
+    ("rule_id", ["hot-room"], "'rule_id' must be a string."),
+    ("belong_to_room", {"name": "rule-room"}, "'belong_to_room' must be a string."),
+    ("window", float("inf"), "'window' must be a non-negative number of seconds."),
+    ("threshold", float("nan"), "'threshold' must be a finite number."),
+    ("threshold", 10 ** 400, "'threshold' must be a finite number."),
+])
+def test_rule_add_invalid_field(client, field, value, error):
+    payload = dict(HOT_ROOM_RULE, **{"window": 60, field: value})
+    response = client.post('/rule/add', json=payload)
+    assert response.status_code == 400
+    assert error in response.get_json()["error"]
+
+def test_rule_remove_non_string_id(client):
+    response = client.post('/rule/remove', json={"rule_id": ["hot-room"]})
+    assert response.status_code == 400
+    assert "'rule_id' must be a string." in response.get_json()["error"]
+
+def test_house_flags_requires_string_house_uid(client):
+    response = client.post('/house/flags', json={"house_uid": ["rule-house"]})
+    assert response.status_code == 400
+    assert "'house_uid' must be a string." in response.get_json()["error"]
+
+def test_rule_remove_clears_flags(client):
+    client.post('/rule/add', json=HOT_ROOM_RULE)
+    report(client, "rule-room", "Thermostat", "temperature", 35.0)
+    assert client.post('/rule/remove', json={"rule_id": "hot-room"}).status_code == 200
+    assert client.post('/rule/query', json={}).get_json()["data"] == []
+    response = client.post('/house/flags', json={"house_uid": "rule-house"})
+    assert response.get_json()["data"] == []
+
+def test_rule_engine_window_must_hold_for_duration():
+    engine = RuleEngine()
+    engine.add(dict(HOT_ROOM_RULE, window=300, aggregate="min"))
+    for seconds in (0, 100, 200):
+        engine.evaluate("rule-room", "temperature", seconds * 1000, 31.0)
+    # Above threshold, but not yet for 5 minutes
+    assert engine.house_flags("rule-house") == []
+
+    engine.evaluate("rule-room", "temperature", 300 * 1000, 32.0)
+    assert engine.house_flags("rule-house")[0]["value"] == 31.0
+
+    # A single cool reading breaks the condition for the next 5 minutes
+    engine.evaluate("rule-room", "temperature", 400 * 1000, 29.0)
+    engine.evaluate("rule-room", "temperature", 500 * 1000, 33.0)
+    assert engine.house_flags("rule-house") == []
+    engine.evaluate("rule-room", "temperature", 701 * 1000, 33.0)
+    assert engine.house_flags("rule-house")[0]["value"] == 33.0
+
+def test_rule_engine_shares_windows_per_key():
+    engine = RuleEngine()
+    engine.add(dict(HOT_ROOM_RULE, rule_id="a", window=60))
+    engine.add(dict(HOT_ROOM_RULE, rule_id="b", window=60, aggregate="max"))
+    engine.add(dict(HOT_ROOM_RULE, rule_id="c", belong_to_room="other-room", window=0))
+    assert len(engine.windows[("rule-room", "temperature")]) == 1
+    engine.remove("a")
+    engine.remove("b")
+    assert ("rule-room", "temperature") not in engine.windows
+
+##################################
+# ANOMALY TESTS
+##################################
+def feed_noise(detector, sid, readings=50):
+    for i in range(readings):
+        detector.update(sid, i * 1000, 20.0 + (i % 5) * 0.1)
+
+def test_anomaly_detector_flags_spike():
+    detector = AnomalyDetector()
+    feed_noise(detector, 3)
+    assert detector.anomalies([3]) == []
+
+    detector.update(3, 60000, 35.0)
+    anomalies = detector.anomalies([3])
+    assert anomalies[0]["reason"] == "spike"
+    assert anomalies[0]["zscore"] > 4.0
+
+    # Back to normal on the next ordinary reading
+    detector.update(3, 61000, 20.1)
+    assert detector.anomalies([3]) == []
+
+def test_anomaly_detector_flags_stuck():
+    detector = AnomalyDetector()
+    for i in range(30):
+        detector.update(0, i * 1000, 21.0)
+    assert detector.anomalies([0])[0]["reason"] == "stuck"
+    assert detector.anomalies([0])[0]["std"] == 0.0
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_anomaly_sweep_flags_silent(monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(app_module, "optional_import", lambda name: None)
+    detector = AnomalyDetector()
+    feed_noise(detector, 0, readings=20)
+    feed_noise(detector, 1, readings=20)
+    detector.update(1, 10 ** 9, 20.0)
+
+    detector.sweep(now=10 ** 9)
+    assert [a["sid"] for a in detector.anomalies([0, 1])] == [0]
+    assert detector.anomalies([0])[0]["reason"] == "silent"
+
+def test_house_anomalies_lists_stuck_device(client):
+    room = {"name": "anomaly-room", "belong_to_house": "anomaly-house", "size": 10, "floor": 1}
+    client.post('/room/add', json=room)
+    for _ in range(30):
+        report(client, "anomaly-room", "Hygrometer", "humidity", 50.0)
+    response = client.post('/house/anomalies', json={"house_uid": "anomaly-house"})
+    assert response.status_code == 200
+    data = response.get_json()["data"]
+    assert [(a["name"], a["reason"]) for a in data] == [("Hygrometer", "stuck")]
+
+def test_anomaly_sweeper_runs_without_main():
+    # Servers that import app (e.g. loadtest.py, WSGI) get the sweeper too
+    assert "anomaly-sweeper" in [thread.name for thread in threading.enumerate()]
+
+##################################
+# SHARDING TESTS
+##################################
+def house_change(uid):
+    return ("houses", "add", {"name": uid, "lat": 0.0, "lon": 0.0, "addr": "-",
+                              "uid": uid, "floors": 1, "size": 10})
+
+def test_sharded_storage_keeps_house_on_one_shard(tmp_path):
+    sharded = ShardedStorage(4, str(tmp_path))
+    sharded.transaction([
+        house_change("h1"),
+        ("rooms", "add", {"name": "h1-kitchen", "belong_to_house": "h1", "size": 5, "floor": 1}),
+        ("devices", "add", {"name": "Oven", "belong_to_room": "h1-kitchen", "type": "oven"}),
+        ("house_users", "add", {"house_uid": "h1", "user_id": "u1"}),
+    ])
+    home = sharded.shard_for_house("h1")
+    assert sharded.shard_for_room("h1-kitchen") is home
+    assert all(len(rows) == 1 for name, rows in home.entities.tables.items() if name != "users")
+
+def test_sharded_storage_query_fans_out(tmp_path):
+    sharded = ShardedStorage(4, str(tmp_path))
+    uids = [f"house-{i}" for i in range(20)]
+    sharded.transaction([house_change(uid) for uid in uids])
+    assert len({sharded.shard_index(uid) for uid in uids}) > 1
+    assert sorted(h["uid"] for h in sharded.query("houses", {})) == sorted(uids)
+    assert [h["uid"] for h in sharded.query("houses", {"uid": "house-7"})] == ["house-7"]
+
+def test_sharded_storage_cross_shard_rollback(tmp_path):
+    sharded = ShardedStorage(4, str(tmp_path))
+    uids = [f"house-{i}" for i in range(8)]
+    sharded.transaction([house_change(uids[0])])
+    with pytest.raises(ConflictError):
+        sharded.transaction([house_change(uid) for uid in uids[1:]] + [house_change(uids[0])])
+    assert [h["uid"] for h in sharded.query("houses", {})] == [uids[0]]
+
+def test_sharded_storage_cross_shard_journal_is_atomic(tmp_path, monkeypatch):
+    journal = str(tmp_path / "journal")
+    sharded = ShardedStorage(4, str(tmp_path), journal)
+    uids = [f"house-{i}" for i in range(8)]
+    sharded.transaction([house_change(uid) for uid in uids[:4]])
+
+    # The last involved shard fails to write its journal line
+    last = sharded.shard(max(sharded.shard_index(uid) for uid in uids[4:]))
+    def fail(changes, tx=None):
+        raise OSError("disk full")
+    monkeypatch.setattr(last.entities, "journal", fail)
+    with pytest.raises(OSError):
+        sharded.transaction([house_change(uid) for uid in uids[4:]])
+    assert len(sharded.query("houses", {})) == 4
+
+    # Lines already written by the other shards are never replayed
+    reopened = ShardedStorage(4, str(tmp_path), journal)
+    assert sorted(h["uid"] for h in reopened.query("houses", {})) == sorted(uids[:4])
+
+def test_sharded_storage_reloads_room_routing(tmp_path):
+    journal = str(tmp_path / "journal")
+    sharded = ShardedStorage(3, str(tmp_path), journal)
+    sharded.transaction([
+        house_change("h2"),
+        ("rooms", "add", {"name": "h2-den", "belong_to_house": "h2", "size": 5, "floor": 1}),
+    ])
+    reopened = ShardedStorage(3, str(tmp_path), journal)
+    assert reopened.house_of_room("h2-den") == "h2"
+    assert reopened.rooms_of("h2") == ["h2-den"]
+
+def test_sharded_storage_room_names_unique_across_houses(tmp_path):
+    sharded = ShardedStorage(4, str(tmp_path))
+    kitchen = {"name": "kitchen", "belong_to_house": "house-a", "size": 5, "floor": 1}
+    sharded.transaction([
+        house_change("house-a"),
+        ("rooms", "add", kitchen),
+        ("devices", "add", {"name": "Oven", "belong_to_room": "kitchen", "type": "oven"}),
+    ])
+    with pytest.raises(ConflictError, match="already belongs to house 'house-a'") as error:
+        sharded.transaction([house_change("house-b"), ("rooms", "add", dict(kitchen, belong_to_house="house-b"))])
+    assert error.value.index == 1
+    # Removing a room the other house never had leaves the mapping alone
+    sharded.transaction([("rooms", "remove", dict(kitchen, belong_to_house="house-b"))])
+    assert sharded.house_of_room("kitchen") == "house-a"
+    assert [d["name"] for d in sharded.query("devices", {"belong_to_room": "kitchen"})] == ["Oven"]
+
+    reopened = ShardedStorage(4, str(tmp_path))
+    assert reopened.room_shard("kitchen") == reopened.shard_index("house-a")
+
+def test_removed_room_name_stays_with_its_house(client, tmp_path):
+    kitchen = {"name": "shared-kitchen", "belong_to_house": "alice", "size": 5, "floor": 1}
+    assert client.post('/room/add', json=kitchen).status_code == 201
+    client.post('/device/add', json={"name": "Oven", "belong_to_room": "shared-kitchen", "type": "oven"})
+    report(client, "shared-kitchen", "Oven", "temperature", 60.0)
+    assert client.post('/room/remove', json=kitchen).status_code == 200
+
+    # Another house cannot take over the name, and with it the old devices and readings
+    response = client.post('/room/add', json=dict(kitchen, belong_to_house="bob"))
+    assert response.status_code == 409
+    assert "already belongs to house 'alice'" in response.get_json()["error"]
+    assert client.post('/room/add', json=kitchen).status_code == 201
+
+    reopened = ShardedStorage(app_module.STORAGE_SHARDS, str(tmp_path / "sensor_data"))
+    assert reopened.house_of_room("shared-kitchen") == "alice"
+
+def test_room_reporting_before_add_keeps_its_series(client):
+    # A room name whose default shard differs from its house's shard
+    room = next(f"garage-{i}" for i in range(100)
+                if app_module.storage.shard_index(f"garage-{i}") != app_module.storage.shard_index("early-house"))
+    report(client, room, "Thermostat", "temperature", 18.0)
+    payload = {"name": room, "belong_to_house": "early-house", "size": 10, "floor": 1}
+    assert client.post('/room/add', json=payload).status_code == 201
+    report(client, room, "Thermostat", "temperature", 19.0)
+
+    response = client.post('/device/sensor_stats', json={"house_uid": "early-house"})
+    assert response.get_json()["data"]["count"] == 2
+    response = client.post('/device/sensor_export', json={"belong_to_room": room})
+    assert len(response.get_data(as_text=True).splitlines()) == 3
+
+def test_sharded_storage_refuses_other_shard_count(tmp_path):
+    journal = str(tmp_path / "journal")
+    ShardedStorage(4, str(tmp_path / "data"), journal).transaction([house_change("h1")])
+    with pytest.raises(RuntimeError, match="records 4 storage shards"):
+        ShardedStorage(3, str(tmp_path / "data"), journal)
+    # The journals alone also remember the count
+    with pytest.raises(RuntimeError, match="records 4 storage shards"):
+        ShardedStorage(8, str(tmp_path / "fresh"), journal)
+
+##################################
+# STARTUP TESTS
+##################################
+def test_sharded_storage_loads_shards_on_demand(tmp_path):
+    journal = str(tmp_path / "journal")
+    ShardedStorage(4, str(tmp_path), journal).transaction(
+        [house_change(f"house-{i}") for i in range(8)])
+
+    reopened = ShardedStorage(4, str(tmp_path), journal)
+    assert reopened.progress()["shards_loaded"] == 0
+    assert len(reopened.query("houses", {"uid": "house-3"})) == 1
+    assert reopened.progress()["shards_loaded"] == 1
+
+    reopened.warm_up()
+    assert reopened.progress() == {"warm": True, "shards_loaded": 4, "shards": 4, "progress": 1.0}
+
+def test_room_routing_does_not_load_other_shards(tmp_path):
+    journal = str(tmp_path / "journal")
+    fleet = Fleet(houses=8, rooms_per_house=2, devices_per_room=1)
+    sharded = ShardedStorage(4, str(tmp_path), journal)
+    for house in range(fleet.houses):
+        changes = []
+        for operation in fleet.provision_operations(house):
+            _, table, action, _, _ = app_module.OPERATIONS[operation["op"]]
+            changes.append((table, action, operation["data"]))
+        sharded.transaction(changes)
+
+    # Device calls and sensor reports route through the persisted room index
+    reopened = ShardedStorage(4, str(tmp_path), journal)
+    room = fleet.room_name(5, 1)
+    assert len(reopened.query("devices", {"belong_to_room": room})) == 1
+    assert reopened.progress()["shards_loaded"] == 1
+    assert reopened.shard_for_room(room, pin=True) is reopened.shard_for_house(fleet.house_uid(5))
+    assert reopened.progress()["shards_loaded"] == 1
+
+def test_room_add_does_not_load_other_shards(tmp_path):
+    journal = str(tmp_path / "journal")
+    fleet = Fleet(houses=8, rooms_per_house=2, devices_per_room=1)
+    sharded = ShardedStorage(4, str(tmp_path), journal)
+    sharded.transaction([house_change(fleet.house_uid(house)) for house in range(fleet.houses)])
+    sharded.transaction([("rooms", "add", {"name": fleet.room_name(1, 0), "belong_to_house": fleet.house_uid(1),
+                                           "size": 5, "floor": 1})])
+
+    reopened = ShardedStorage(4, str(tmp_path), journal)
+    room = {"name": "new-room", "belong_to_house": fleet.house_uid(5), "size": 5, "floor": 1}
+    reopened.transaction([("rooms", "add", room)])
+    assert reopened.progress()["shards_loaded"] == 1
+    # Names owned by another house are refused from the room index alone
+    with pytest.raises(ConflictError):
+        reopened.transaction([("rooms", "add", dict(room, name=fleet.room_name(1, 0)))])
+    assert reopened.progress()["shards_loaded"] == 1
+
+def test_opening_storage_writes_nothing(tmp_path):
+    journal = str(tmp_path / "journals" / "journal")
+    os.makedirs(tmp_path / "journals")
+    sharded = ShardedStorage(4, str(tmp_path / "data"), journal)
+    sharded.warm_up()
+    assert sharded.query("houses", {}) == []
+    assert not os.path.exists(tmp_path / "data") and os.listdir(tmp_path / "journals") == []
+
+    # The shard count is recorded with the first write
+    sharded.transaction([house_change("h1")])
+    assert os.path.exists(tmp_path / "data" / "storage.json") and os.path.exists(journal + ".layout")
+
+def test_ready_reports_warmup_progress(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module, "storage", ShardedStorage(2, str(tmp_path)))
+    response = client.get('/ready')
+    assert response.status_code == 200
+    assert response.get_json()["shards_loaded"] == 0
+
+    assert client.get('/ready?warm=1').status_code == 503
+    app_module.storage.warm_up()
+    response = client.get('/ready?warm=1')
+    assert response.status_code == 200
+    assert response.get_json()["progress"] == 1.0
+
+##################################
+# LOAD TEST HARNESS TESTS
+##################################
+def test_loadtest_fleet_payloads_are_accepted(client):
+    fleet = Fleet(houses=2, rooms_per_house=2, devices_per_room=2)
+    for house in range(fleet.houses):
+        operations = fleet.provision_operations(house)
+        response = client.post('/batch', json={"operations": operations})
+        assert response.status_code == 200
+    assert len(client.post('/device/query', json={}).get_json()["data"]) == fleet.devices
+
+    rng = random.Random(0)
+    for report_id in range(20):
+        payload = fleet.sensor_report(rng, report_id)
+        assert client.post('/device/sensor_report', json=payload).status_code == 200
+
+def test_loadtest_report_ids_unique_across_runs():
+    class RecordingPool:
+        def __init__(self):
+            self.report_ids = []
+
+        async def post(self, path, payload):
+            self.report_ids.append(payload["report_id"])
+            return 200, b"{}", asyncio.get_running_loop().time()
+
+    pool = RecordingPool()
+    fleet = Fleet(houses=1)
+    for _ in range(2):
+        asyncio.run(replay_reports(pool, fleet, rate=2000, duration=0.01))
+    assert len(pool.report_ids) > 2
+    assert len(set(pool.report_ids)) == len(pool.report_ids)
+
+def test_loadtest_histogram_percentiles():
+    histogram = LatencyHistogram()
+    for millis in range(1, 101):
+        histogram.record(millis / 1000)
+    assert histogram.count == 100
+    assert histogram.percentile(50) == pytest.approx(0.050, rel=0.01)
+    assert histogram.percentile(99) == pytest.approx(0.099, rel=0.01)
+    assert histogram.percentile(100) == histogram.max == 0.1
+
 ##################################
 # USERS TESTS
 ##################################